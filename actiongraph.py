@@ -0,0 +1,125 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import cancellation
+import tracing
+
+class GraphError(Exception):
+  pass
+
+class ActionGraph:
+  ''' Orders a list of actions by their dependencies
+
+  An action without an explicit "after" list depends on the action
+  before it, which keeps plain configurations strictly sequential.
+  An explicit list (even an empty one) replaces that implicit
+  dependency, allowing independent branches to run side by side.
+  '''
+  def __init__(self, actions):
+    self.actions = list(actions)
+    self.depends = self._resolve()
+    self.linear = all(d == ({i - 1} if i else set()) for i, d in enumerate(self.depends))
+    self._check_cycles()
+
+  def _resolve(self):
+    names = {}
+    for i, action in enumerate(self.actions):
+      if action.id is None:
+        continue
+      if action.id in names:
+        raise GraphError(f'Step "{action.id}" is defined more than once')
+      names[action.id] = i
+
+    depends = []
+    for i, action in enumerate(self.actions):
+      if action.after is None:
+        depends.append({i - 1} if i else set())
+        continue
+      deps = set()
+      for name in action.after:
+        if name not in names:
+          raise GraphError(f'Step "{name}" referenced by "after" does not exist')
+        deps.add(names[name])
+      depends.append(deps)
+    return depends
+
+  def _check_cycles(self):
+    remaining = {i : set(d) for i, d in enumerate(self.depends)}
+    while remaining:
+      ready = [i for i, d in remaining.items() if not d]
+      if not ready:
+        cycle = ', '.join(str(self.actions[i].id or i) for i in sorted(remaining))
+        raise GraphError(f'Steps {cycle} depend on each other')
+      for i in ready:
+        del remaining[i]
+      for d in remaining.values():
+        d.difference_update(ready)
+
+  def run(self, func, executor=None):
+    ''' Calls func(action) for each action once all its dependencies are done
+
+    Without an executor, or when the graph is a plain sequence, everything
+    runs on the calling thread. Should an action raise, or the current
+    cancel token be cancelled, no further actions are started and the
+    exception is re-raised once running ones complete.
+    '''
+    token = cancellation.current()
+    if executor is None or self.linear:
+      for action in self.actions:
+        token.check()
+        func(action)
+      return
+
+    def step(action):
+      token.check()
+      func(action)
+    step = tracing.bind(cancellation.bind(step))
+
+    dependents = {i : [] for i in range(len(self.actions))}
+    for i, deps in enumerate(self.depends):
+      for d in deps:
+        dependents[d].append(i)
+    pending = {i : set(d) for i, d in enumerate(self.depends)}
+    ready = [i for i, d in pending.items() if not d]
+    running = {}
+    error = None
+
+    while ready or running:
+      for i in ready:
+        del pending[i]
+        running[executor.submit(step, self.actions[i])] = i
+      ready = []
+
+      done, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in done:
+        i = running.pop(future)
+        if future.exception():
+          if error is None:
+            error = future.exception()
+          if not isinstance(future.exception(), cancellation.Cancelled):
+            logging.error(f'Step {self.actions[i].id or i} failed: {future.exception()}')
+          continue
+        for j in dependents[i]:
+          pending[j].discard(i)
+          if not pending[j]:
+            ready.append(j)
+      if error is not None:
+        ready = []
+
+    if error is not None:
+      raise error
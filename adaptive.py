@@ -0,0 +1,77 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import json
+import logging
+from threading import Lock
+
+class DelayStats:
+  ''' Remembers how long adaptive delays actually needed
+
+  The most recent "keep" samples of each delay are kept in a JSON file,
+  so what was learned survives restarts.
+  '''
+  def __init__(self, file, keep=10):
+    self.file = file
+    self.keep = keep
+    self.samples = None
+    self.lock = Lock()
+
+  def _load(self):
+    if self.samples is not None:
+      return
+    self.samples = {}
+    if not os.path.exists(self.file):
+      return
+    try:
+      with open(self.file) as f:
+        data = json.load(f)
+      self.samples = {key : [float(value) for value in values] for key, values in data.items() if isinstance(values, list)}
+    except:
+      logging.exception(f'Unable to read {self.file}, starting over')
+
+  def _save(self):
+    try:
+      with open(self.file + '.tmp', 'w') as f:
+        json.dump(self.samples, f, indent=1)
+      os.replace(self.file + '.tmp', self.file)
+    except:
+      logging.exception(f'Unable to write {self.file}')
+
+  def add(self, key, seconds):
+    with self.lock:
+      self._load()
+      samples = self.samples.setdefault(key, [])
+      samples.append(round(seconds, 3))
+      del samples[:-self.keep]
+      self._save()
+
+  def learned(self, key, percentile, minimum):
+    ''' The percentile of what the delay needed, or None with fewer than minimum samples '''
+    with self.lock:
+      self._load()
+      samples = sorted(self.samples.get(key, []))
+    if not samples or len(samples) < minimum:
+      return None
+    return samples[min(len(samples) - 1, int(round(percentile / 100 * (len(samples) - 1))))]
+
+_stats = None
+
+def stats():
+  global _stats
+  if _stats is None:
+    _stats = DelayStats('adaptive.json')
+  return _stats
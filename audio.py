@@ -0,0 +1,136 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+import time
+import logging
+from threading import Condition, Lock
+
+import cancellation
+
+class AudioBackend:
+  ''' Access to the audio devices
+
+  A backend reports that something changed (a device was added, removed,
+  changed state or became the default) by calling the notify function
+  given to start(), from any thread.
+  '''
+  def start(self, notify):
+    raise NotImplementedError()
+
+  def active(self):
+    ''' True if there's a default output device and it's active '''
+    raise NotImplementedError()
+
+class FakeBackend(AudioBackend):
+  ''' Audio device which is switched on and off by hand, for trying audio waits without Windows '''
+  def __init__(self, active=False):
+    self.notify = lambda: None
+    self.state = active
+
+  def start(self, notify):
+    self.notify = notify
+
+  def set(self, active):
+    self.state = active
+    self.notify()
+
+  def active(self):
+    return self.state
+
+class AudioMonitor:
+  ''' Keeps track of whether the default audio output is active
+
+  The state is read again whenever the backend reports a change, and
+  once every "recheck" seconds in case a change went unreported, so
+  waiting on it costs nothing in between.
+  '''
+  def __init__(self, backend, recheck=5.0):
+    self.backend = backend
+    self.recheck = recheck
+    self.state = None
+    self.condition = Condition()
+    try:
+      backend.start(self._update)
+    except:
+      logging.exception('Unable to listen for audio device changes, checking regularly instead')
+      self.recheck = 0.1
+    self._update()
+
+  def _update(self):
+    try:
+      state = bool(self.backend.active())
+    except:
+      # No default audio path available
+      state = False
+    with self.condition:
+      changed = state != self.state
+      self.state = state
+      self.condition.notify_all()
+    if changed:
+      logging.debug(f'Default audio output is {"active" if state else "inactive"}')
+
+  def _wake(self):
+    with self.condition:
+      self.condition.notify_all()
+
+  def active(self):
+    with self.condition:
+      return self.state
+
+  def wait(self, timeout=0):
+    ''' Waits until the default audio output is active, True if it is
+
+    A timeout of zero means waiting forever. Raises Cancelled if the
+    current cancel token is cancelled while waiting.
+    '''
+    deadline = time.monotonic() + timeout if timeout > 0 else None
+    token = cancellation.current()
+    forget = token.onCancel(self._wake)
+    try:
+      while True:
+        token.check()
+        delay = self.recheck
+        if deadline is not None:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            return self.active()
+          delay = min(delay, remaining)
+        with self.condition:
+          if self.state:
+            return True
+          if self.condition.wait(delay):
+            continue
+        if deadline is None or time.monotonic() < deadline:
+          self._update()
+    finally:
+      forget()
+
+_monitor = None
+_lock = Lock()
+
+def install(backend):
+  ''' Replaces the audio backend used by the local endpoint '''
+  global _monitor
+  with _lock:
+    _monitor = AudioMonitor(backend)
+  return _monitor
+
+def monitor(default=None):
+  ''' Returns the shared monitor, creating it from default() if needed '''
+  global _monitor
+  with _lock:
+    if _monitor is None and default is not None:
+      _monitor = AudioMonitor(default())
+    return _monitor
@@ -0,0 +1,114 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' Endpoints which only pretend, for measuring window opener itself '''
+import os
+import sys
+import time
+import itertools
+from threading import Lock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cancellation
+from programs import ProgramManager
+
+class FakeEndpoint:
+  ''' Stands in for LocalEndpoint/RemoteEndpoint
+
+  Every call takes "latency" seconds and is recorded in the journal as
+  (time, endpoint, method, arguments). Delays are scaled by "timescale".
+  '''
+  def __init__(self, name, latency=0.0, timescale=0.0, journal=None):
+    self.name = name
+    self.latency = latency
+    self.timescale = timescale
+    self.journal = journal if journal is not None else []
+    self.batching = False
+    self.pids = itertools.count(1000)
+    self.running = set()
+    self.lock = Lock()
+
+  def _act(self, method, *arguments):
+    if self.latency:
+      time.sleep(self.latency)
+    with self.lock:
+      self.journal.append((time.monotonic(), self.name, method, arguments))
+
+  def execute(self, options, cmdline):
+    with self.lock:
+      pid = next(self.pids)
+      self.running.add(pid)
+    self._act('execute', *cmdline)
+    return pid
+
+  def kill_pid(self, options, pid):
+    with self.lock:
+      found = pid in self.running
+      self.running.discard(pid)
+    self._act('kill pid', pid)
+    return found
+
+  def reveal(self, options, pid):
+    with self.lock:
+      found = pid in self.running
+    self._act('reveal', pid)
+    return found
+
+  def delay(self, options, duration):
+    cancellation.current().sleep(float(duration) * self.timescale)
+    self._act('delay', duration)
+    return True
+
+  def close_window(self, options, window=None):
+    self._act('close window', window)
+    return True
+
+  def kill_app(self, options, *appnames):
+    self._act('kill app', *appnames)
+    return True
+
+  def sendkeys(self, options, keys):
+    self._act('sendkeys', keys)
+    return True
+
+  def focus(self, options, window):
+    self._act('focus', window)
+    return True
+
+  def mouse_move(self, options, x, y):
+    self._act('mouse move', x, y)
+    return True
+
+  def windows(self, options):
+    self._act('windows')
+    return []
+
+def build_manager(programs=4, actions=3, endpoints=None, workers=4):
+  ''' Creates a ProgramManager whose programs only use fake endpoints
+
+  Program "p<N>" executes "p<N>" with the action index as argument on
+  each endpoint in turn, so the journal shows who did what.
+  '''
+  pm = ProgramManager(workers=workers)
+  endpoints = endpoints or [FakeEndpoint('local')]
+  for endpoint in endpoints:
+    pm.endpoints[endpoint.name] = endpoint
+  for p in range(programs):
+    prg = pm.createProgram(f'p{p}')
+    for a in range(actions):
+      prg.addStartAction(endpoints[a % len(endpoints)], 'execute', f'p{p}', a)
+    prg.addStopAction(endpoints[0], 'close window', f'p{p}')
+  return pm
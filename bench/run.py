@@ -0,0 +1,316 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' Runs the whole benchmark suite and prints the results as JSON
+
+Everything runs headless: programs use fake endpoints with simulated
+latencies, remote endpoints talk to a fake remote, and the web server
+runs with the Windows-only modules replaced by empty stand-ins. The
+output carries the commit and Python version so runs of different
+versions can be compared.
+'''
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import itertools
+import statistics
+import subprocess
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+import startup
+from fakes import FakeEndpoint, build_manager
+from configuration import Config
+from endpoints import RemoteEndpoint
+
+BENCHMARKS = ['startup', 'config', 'switch', 'lowlevel', 'remote']
+
+def summarize(samples):
+  ''' Condenses a list of durations (in seconds) '''
+  ordered = sorted(samples)
+  def percentile(p):
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+  return {
+    'count' : len(ordered),
+    'min' : ordered[0],
+    'p50' : percentile(50),
+    'p90' : percentile(90),
+    'p99' : percentile(99),
+    'max' : ordered[-1],
+    'mean' : statistics.mean(ordered),
+  }
+
+def timed(func, *args):
+  started = time.perf_counter()
+  func(*args)
+  return time.perf_counter() - started
+
+def concurrently(threads, func):
+  ''' Runs func(n) on each of the threads, returns the wall time and all samples '''
+  samples = [[] for i in range(threads)]
+  workers = [Thread(target=lambda n=n: samples[n].extend(func(n))) for n in range(threads)]
+  started = time.perf_counter()
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  return time.perf_counter() - started, list(itertools.chain(*samples))
+
+def bench_startup(args):
+  with tempfile.TemporaryDirectory() as folder:
+    stubs = startup.prepare(folder)
+    samples = [startup.measure(folder, stubs, 30) for i in range(args.runs)]
+  return {'time_to_first_request' : summarize(samples)}
+
+INCLUDE = '''
+start:
+  - method: execute
+    arguments: [{app}, --fullscreen]
+  - method: delay
+    arguments: 1
+  - method: focus
+    arguments: {title}
+    options:
+      waitforit: true
+      maxwait: 10
+stop:
+  - method: kill app
+    arguments: [{app}]
+'''
+
+def write_config(folder, programs, includes):
+  ''' Writes a configuration with the given number of programs, every
+  "includes"th of them coming from one of a few include files
+  '''
+  lines = ['endpoints:']
+  for e in range(4):
+    lines += [f'  remote{e}:', f'    url: http://127.0.0.1:9', f'    token: "{{token{e}}}"']
+  lines.append('programs:')
+  for p in range(programs):
+    lines.append(f'  program{p}:')
+    if includes and p % includes == 0:
+      lines += [f'    include: include{p % 10}.yml', '    parameters:', f'      app: app{p}.exe', f'      title: Window {p}']
+      continue
+    lines += [
+      '    start:',
+      '      - method: execute',
+      f'        endpoint: remote{p % 4}',
+      f'        arguments: [app{p}.exe]',
+      '        name: launch',
+      '      - method: sendkeys',
+      f'        arguments: "{{{{ENTER}}}}"',
+      '        after: [launch]',
+      '    stop:',
+      '      - method: close window',
+      f'        arguments: Window {p}',
+    ]
+  with open(os.path.join(folder, 'config.yml'), 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  with open(os.path.join(folder, 'secrets.yml'), 'w') as f:
+    f.write('token: secret\nsecrets:\n' + ''.join(f'  token{e}: remote{e}\n' for e in range(4)))
+  for i in range(10):
+    with open(os.path.join(folder, f'include{i}.yml'), 'w') as f:
+      f.write(INCLUDE)
+
+def bench_config(args):
+  cwd = os.getcwd()
+  with tempfile.TemporaryDirectory() as folder:
+    write_config(folder, args.programs, args.includes)
+    os.chdir(folder)
+    try:
+      config = Config()
+      load = [timed(config.load) for i in range(args.runs)]
+      programs = len(config.getProgramManager().getPrograms())
+      reload = [timed(config.reload) for i in range(args.runs)]
+    finally:
+      os.chdir(cwd)
+  return {
+    'programs' : programs,
+    'load' : summarize(load),
+    'reload_unchanged' : summarize(reload),
+  }
+
+def bench_switch(args):
+  results = {}
+  for latency in args.latencies:
+    pm = build_manager(programs=2, actions=args.actions, endpoints=[FakeEndpoint('local', latency=latency)])
+    pm.start('p1')
+    samples = [timed(pm.start, f'p{i % 2}') for i in range(args.switches)]
+    pm.stop()
+    # Each switch stops the previous program (finish every action and
+    # one stop action) and starts the next one
+    simulated = (2 * args.actions + 1) * latency
+    results[f'latency_{latency}'] = {
+      'switch' : summarize(samples),
+      'simulated' : simulated,
+      'overhead_p50' : summarize(samples)['p50'] - simulated,
+    }
+  return results
+
+LOWLEVEL_CONFIG = '''
+programs:
+  first:
+    start:
+      - method: sendkeys
+        arguments: one
+      - method: mouse move
+        arguments: [10, 10]
+    stop:
+      - method: sendkeys
+        arguments: two
+  second:
+    start:
+      - method: sendkeys
+        arguments: three
+'''
+
+def bench_lowlevel(args):
+  with tempfile.TemporaryDirectory() as folder:
+    stubs = startup.prepare(folder)
+    with open(os.path.join(folder, 'config.yml'), 'w') as f:
+      f.write(LOWLEVEL_CONFIG)
+    proc, port, elapsed = startup.launch(folder, stubs, 30, '--threads', str(args.threads))
+    url = f'http://127.0.0.1:{port}'
+    try:
+      def calls(n):
+        session = requests.Session()
+        samples = []
+        for i in range(args.requests):
+          started = time.perf_counter()
+          session.post(f'{url}/lowlevel/sendkeys', json={'arguments' : ['x'], 'token' : 'secret'}).raise_for_status()
+          samples.append(time.perf_counter() - started)
+        return samples
+      wall, lowlevel = concurrently(args.threads, calls)
+
+      session = requests.Session()
+      switches = []
+      for i in range(args.switches):
+        started = time.perf_counter()
+        session.post(f'{url}/program', json={'start' : ['first', 'second'][i % 2], 'token' : 'secret'}).raise_for_status()
+        switches.append(time.perf_counter() - started)
+    finally:
+      proc.terminate()
+      proc.wait()
+  return {
+    'threads' : args.threads,
+    'lowlevel' : summarize(lowlevel),
+    'lowlevel_per_second' : len(lowlevel) / wall,
+    'program_switch' : summarize(switches),
+  }
+
+class FakeRemote(BaseHTTPRequestHandler):
+  ''' Answers lowlevel calls like a remote window opener would, after "latency" seconds '''
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+  latency = 0.0
+  pids = itertools.count(1000)
+
+  def do_POST(self):
+    body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+    time.sleep(self.latency)
+    if self.path == '/lowlevel/batch':
+      reply = {'results' : [{'result' : True, 'duration' : 0.0} for entry in body['actions']]}
+    elif self.path == '/lowlevel/execute':
+      reply = {'result' : next(FakeRemote.pids)}
+    else:
+      reply = {'result' : True}
+    data = json.dumps(reply).encode()
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, *args):
+    pass
+
+def bench_remote(args):
+  results = {}
+  for latency in args.latencies:
+    handler = type('Remote', (FakeRemote,), {'latency' : latency})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = RemoteEndpoint('remote', f'http://127.0.0.1:{server.server_address[1]}', 'secret', pool_size=args.threads)
+    try:
+      def calls(n):
+        samples = []
+        for i in range(args.requests):
+          started = time.perf_counter()
+          endpoint.sendkeys({}, 'x')
+          samples.append(time.perf_counter() - started)
+        return samples
+      wall, samples = concurrently(args.threads, calls)
+      batch = [timed(endpoint.batch, [{'method' : 'sendkeys', 'arguments' : ['x'], 'options' : {}}] * args.actions) for i in range(args.switches)]
+    finally:
+      server.shutdown()
+      server.server_close()
+    results[f'latency_{latency}'] = {
+      'threads' : args.threads,
+      'call' : summarize(samples),
+      'calls_per_second' : len(samples) / wall,
+      'overhead_p50' : summarize(samples)['p50'] - latency,
+      f'batch_of_{args.actions}' : summarize(batch),
+    }
+  return results
+
+def commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=startup.ROOT, capture_output=True, text=True).stdout.strip() or None
+  except OSError:
+    return None
+
+def main():
+  parser = argparse.ArgumentParser(description='Window opener benchmark suite', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='Benchmarks to run')
+  parser.add_argument('--runs', type=int, default=5, help='Repetitions of startup and configuration loading')
+  parser.add_argument('--programs', type=int, default=500, help='Programs in the generated configuration')
+  parser.add_argument('--includes', type=int, default=2, help='Every Nth generated program comes from an include file (0 for none)')
+  parser.add_argument('--actions', type=int, default=5, help='Start actions per program when switching, actions per remote batch')
+  parser.add_argument('--switches', type=int, default=100, help='Program switches to measure')
+  parser.add_argument('--latencies', type=float, nargs='+', default=[0.0, 0.005], help='Simulated seconds per fake endpoint call')
+  parser.add_argument('--threads', type=int, default=8, help='Concurrent callers for lowlevel and remote calls')
+  parser.add_argument('--requests', type=int, default=200, help='Calls per concurrent caller')
+  parser.add_argument('--output', default=None, help='Write the results to this file as well')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.CRITICAL)
+
+  results = {}
+  for name in args.only:
+    print(f'Running {name}', file=sys.stderr)
+    results[name] = globals()[f'bench_{name}'](args)
+
+  report = json.dumps({
+    'commit' : commit(),
+    'python' : platform.python_version(),
+    'platform' : platform.platform(),
+    'time' : time.time(),
+    'parameters' : vars(args),
+    'results' : results,
+  }, indent=2)
+  print(report)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(report + '\n')
+
+if __name__ == '__main__':
+  main()
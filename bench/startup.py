@@ -0,0 +1,143 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' Measures how long window opener takes from launch to answering its first request
+
+The Windows-only modules are replaced by empty stand-ins, so this runs
+anywhere Flask, PyYAML and requests are installed. Results are printed
+as JSON.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import statistics
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Anything looked up in these, and anything that returns, accepts any
+# call or attribute and does nothing
+STUB = '''
+class Anything:
+  def __call__(self, *args, **kwargs):
+    return self
+  def __getattr__(self, name):
+    return self
+  def __or__(self, other):
+    return self
+  def __ror__(self, other):
+    return self
+
+def __getattr__(name):
+  return Anything()
+'''
+STUBS = ['win32gui', 'win32api', 'win32con', 'win32process', 'pythoncom', 'win32com/__init__', 'win32com/client', 'pycaw/__init__', 'pycaw/pycaw', 'pycaw/callbacks']
+
+CONFIG = '''
+endpoints:
+  remote:
+    url: http://127.0.0.1:9
+    token: secret
+programs:
+  demo:
+    start:
+      - method: execute
+        arguments: [demo.exe]
+      - method: execute
+        endpoint: remote
+        arguments: [demo.exe]
+'''
+
+def prepare(folder):
+  stubs = os.path.join(folder, 'stubs')
+  for name in STUBS:
+    path = os.path.join(stubs, name + '.py')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      f.write(STUB)
+  with open(os.path.join(folder, 'config.yml'), 'w') as f:
+    f.write(CONFIG)
+  with open(os.path.join(folder, 'secrets.yml'), 'w') as f:
+    f.write('token: secret\n')
+  return stubs
+
+def free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+def launch(folder, stubs, timeout, *args):
+  ''' Starts window opener in folder and waits until it answers
+
+  Returns the process, the port it listens on and how long it took.
+  '''
+  port = free_port()
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join([stubs, ROOT, env.get('PYTHONPATH', '')])
+  started = time.perf_counter()
+  proc = subprocess.Popen(
+    [sys.executable, os.path.join(ROOT, 'windowopener.py'), '--port', str(port), '--listen', '127.0.0.1', *args],
+    cwd=folder, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+  )
+  try:
+    while time.perf_counter() - started < timeout:
+      try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/program', timeout=1) as r:
+          r.read()
+          return proc, port, time.perf_counter() - started
+      except OSError:
+        if proc.poll() is not None:
+          raise RuntimeError(f'window opener exited with {proc.returncode}')
+        time.sleep(0.005)
+    raise RuntimeError('Timed out waiting for the first response')
+  except:
+    proc.terminate()
+    proc.wait()
+    raise
+
+def measure(folder, stubs, timeout):
+  proc, port, elapsed = launch(folder, stubs, timeout)
+  proc.terminate()
+  proc.wait()
+  return elapsed
+
+def main():
+  parser = argparse.ArgumentParser(description='Time-to-first-request benchmark')
+  parser.add_argument('--runs', type=int, default=5, help='Number of launches to measure')
+  parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for each launch')
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as folder:
+    stubs = prepare(folder)
+    samples = [measure(folder, stubs, args.timeout) for i in range(args.runs)]
+
+  print(json.dumps({
+    'benchmark' : 'startup',
+    'runs' : args.runs,
+    'time_to_first_request' : {
+      'min' : min(samples),
+      'median' : statistics.median(samples),
+      'max' : max(samples),
+    },
+    'samples' : samples,
+  }, indent=2))
+
+if __name__ == '__main__':
+  main()
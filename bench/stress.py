@@ -0,0 +1,165 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' Hammers a ProgramManager with concurrent switches and reads
+
+Checks that program sequences never interleave, that no PIDs are left
+behind (even when a newer switch cancels a start), that coalescing
+queued switches never drops a stop which is still needed, and reports
+how long reads took while switches were going on. With --slots the programs
+share out that many resources, so several of them can be active at once.
+Exits with status 1 if any check fails.
+'''
+import sys
+import json
+import logging
+import time
+import random
+import argparse
+import statistics
+from threading import Thread
+
+from fakes import FakeEndpoint, build_manager
+
+def check_sequences(journal):
+  ''' Start sequences must run in order without anything else in between
+
+  A sequence may end early when a newer switch cancels it.
+  '''
+  errors = []
+  previous = None
+  for entry in journal:
+    if entry[2] != 'execute':
+      continue
+    program, index = entry[3]
+    if index != 0 and previous != (program, index - 1):
+      errors.append(f'{(program, index)} followed {previous}')
+    previous = (program, index)
+  return errors
+
+# Requests queued while the command thread is busy, with the resources of
+# each program (None for conflicting with everything), and the programs
+# which have to be active once they're done
+QUEUED = [
+  ({'p0' : None, 'p1' : None}, ['p0'], [('stop', 'p0'), ('start', 'p1'), ('stop', 'p1')], []),
+  ({'p0' : ['a'], 'p1' : ['a', 'b'], 'p2' : ['b']}, ['p0'], [('stop', 'p0'), ('start', 'p1'), ('start', 'p2')], ['p2']),
+  ({'p0' : ['a'], 'p1' : ['a'], 'p2' : ['b']}, ['p0'], [('stop', 'p0'), ('start', 'p1'), ('start', 'p2')], ['p1', 'p2']),
+  ({'p0' : None, 'p1' : None, 'p2' : None}, ['p0'], [('start', 'p1'), ('start', 'p2')], ['p2']),
+]
+
+def check_queued(latency):
+  ''' Coalescing requests waiting their turn must not lose any of them '''
+  errors = []
+  for resources, before, requests, expected in QUEUED:
+    endpoint = FakeEndpoint('local', latency)
+    pm = build_manager(len(resources), 2, [endpoint])
+    for name, needs in resources.items():
+      pm.PROGRAMS[name].setResources(needs)
+    for name in before:
+      pm.start(name)
+    busy = Thread(target=pm.run, args=(time.sleep, 0.2))
+    busy.start()
+    time.sleep(0.05)
+    callers = []
+    for operation, name in requests:
+      callers.append(Thread(target=getattr(pm, operation), args=(name,)))
+      callers[-1].start()
+      # Keeps the requests in order
+      time.sleep(0.01)
+    for t in [busy] + callers:
+      t.join()
+    running = set(action.pid for prg in pm.active.values() for action in prg.START_ACTIONS)
+    if pm.getActivePrograms() != expected or endpoint.running != running:
+      errors.append(f'{requests} after {before} left {pm.getActivePrograms()} active (PIDs {sorted(endpoint.running)}), expected {expected}')
+  return errors
+
+def main():
+  parser = argparse.ArgumentParser(description='Concurrency stress test for program switching')
+  parser.add_argument('--threads', type=int, default=8, help='Number of concurrent callers')
+  parser.add_argument('--operations', type=int, default=50, help='Switches per caller')
+  parser.add_argument('--programs', type=int, default=4)
+  parser.add_argument('--actions', type=int, default=3)
+  parser.add_argument('--latency', type=float, default=0.001, help='Seconds each fake action takes')
+  parser.add_argument('--slots', type=int, default=0, help='Resources shared out between programs (0 for all programs conflicting)')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.ERROR)
+
+  journal = []
+  endpoints = [FakeEndpoint('local', args.latency, journal=journal), FakeEndpoint('remote', args.latency, journal=journal)]
+  pm = build_manager(args.programs, args.actions, endpoints)
+  names = pm.getPrograms()
+  if args.slots > 0:
+    for i, name in enumerate(names):
+      pm.PROGRAMS[name].setResources([f'slot{i % args.slots}'])
+  reads = []
+  done = []
+
+  def switcher(seed):
+    rnd = random.Random(seed)
+    for i in range(args.operations):
+      choice = rnd.random()
+      if choice < 0.8:
+        pm.start(rnd.choice(names))
+      elif choice < 0.9:
+        pm.stop(rnd.choice(names))
+      else:
+        pm.stop()
+    done.append(seed)
+
+  def reader():
+    while len(done) < args.threads:
+      started = time.perf_counter()
+      pm.getActivePrograms()
+      pm.getPrograms()
+      reads.append(time.perf_counter() - started)
+      time.sleep(0.0005)
+
+  started = time.perf_counter()
+  threads = [Thread(target=switcher, args=(i,)) for i in range(args.threads)] + [Thread(target=reader) for i in range(2)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.perf_counter() - started
+
+  errors = check_sequences(journal) + check_queued(args.latency)
+  active = list(pm.active.values())
+  for i, prg in enumerate(active):
+    for other in active[i + 1:]:
+      if prg.conflictsWith(other):
+        errors.append(f'Conflicting programs "{prg.name}" and "{other.name}" are both active')
+  expected = set(action.pid for prg in active for action in prg.START_ACTIONS)
+  leftover = set()
+  for endpoint in endpoints:
+    leftover |= endpoint.running
+  if leftover != expected:
+    errors.append(f'Running PIDs {sorted(leftover)} do not match active program PIDs {sorted(expected)}')
+
+  print(json.dumps({
+    'benchmark' : 'stress',
+    'switches' : args.threads * args.operations,
+    'elapsed' : elapsed,
+    'running' : pm.getActivePrograms(),
+    'reads' : {
+      'count' : len(reads),
+      'median' : statistics.median(reads) if reads else None,
+      'max' : max(reads) if reads else None,
+    },
+    'errors' : errors,
+  }, indent=2))
+  sys.exit(1 if errors else 0)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,135 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' Drives the window and audio waits of the local endpoint with fake backends
+
+Checks that a waiting action wakes up as soon as the event it waits for
+happens (rather than on the next recheck), gives up when its time runs
+out and ends right away when cancelled. Reports how long each took.
+Exits with status 1 if any check fails.
+'''
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from threading import Timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import audio
+import cancellation
+import windowevents
+from endpoints import LocalEndpoint
+
+def timed(func):
+  ''' Returns what func returned (or the exception it raised) and how long it took '''
+  started = time.monotonic()
+  try:
+    ret = func()
+  except Exception as e:
+    ret = e
+  return ret, time.monotonic() - started
+
+def later(delay, func):
+  timer = Timer(delay, func)
+  timer.daemon = True
+  timer.start()
+
+def cancelled(delay, func):
+  ''' Runs func with a cancel token which is cancelled after delay seconds '''
+  token = cancellation.CancelToken()
+  later(delay, token.cancel)
+  with cancellation.activate(token):
+    return func()
+
+def check_windows(args, ep):
+  backend = windowevents.FakeBackend()
+  # Nothing but an event may wake a waiter in time
+  windowevents.install(backend).recheck = 60
+  results = {}
+
+  later(args.delay, lambda: backend.create('Appears'))
+  results['wake_on_create'] = timed(lambda: ep.focus({'waitforit' : True, 'maxwait' : 10}, 'Appears'))
+
+  handle = backend.create('Focus me')
+  later(args.delay, lambda: backend.set_foreground(handle))
+  results['wake_on_foreground'] = timed(lambda: ep.close_window({'whenactive' : True, 'maxwait' : 10}, 'Focus me'))
+
+  results['timeout'] = timed(lambda: ep.focus({'waitforit' : True, 'maxwait' : args.delay}, 'Never'))
+  results['cancel'] = timed(lambda: cancelled(args.delay, lambda: ep.focus({'waitforit' : True}, 'Never')))
+
+  errors = []
+  if results['wake_on_create'][0] is not True:
+    errors.append(f'focus on a new window returned {results["wake_on_create"][0]}')
+  if results['wake_on_foreground'][0] is not True or handle in backend.windows:
+    errors.append(f'close window when active returned {results["wake_on_foreground"][0]}')
+  if results['timeout'][0] is not False:
+    errors.append(f'focus on a missing window returned {results["timeout"][0]}')
+  if not isinstance(results['cancel'][0], cancellation.Cancelled):
+    errors.append(f'cancelled focus returned {results["cancel"][0]}')
+  for name, (ret, elapsed) in results.items():
+    if elapsed > args.delay + args.slack:
+      errors.append(f'{name} took {elapsed:.3f}s, expected about {args.delay}s')
+  return {name : elapsed for name, (ret, elapsed) in results.items()}, errors
+
+def check_audio(args, ep):
+  backend = audio.FakeBackend()
+  audio.install(backend).recheck = 60
+  results = {}
+
+  later(args.delay, lambda: backend.set(True))
+  results['wake_on_device'] = timed(lambda: ep.delay({'orhasaudio' : True}, 10))
+  backend.set(False)
+
+  results['timeout'] = timed(lambda: ep.delay({'orhasaudio' : True}, args.delay))
+  results['cancel'] = timed(lambda: cancelled(args.delay, lambda: ep.delay({'orhasaudio' : True}, 10)))
+
+  errors = []
+  for name in ['wake_on_device', 'timeout']:
+    if isinstance(results[name][0], Exception):
+      errors.append(f'{name} raised {results[name][0]!r}')
+  if results['timeout'][1] < args.delay:
+    errors.append(f'delay without audio ended after {results["timeout"][1]:.3f}s, expected {args.delay}s')
+  if not isinstance(results['cancel'][0], cancellation.Cancelled):
+    errors.append(f'cancelled delay returned {results["cancel"][0]}')
+  for name, (ret, elapsed) in results.items():
+    if elapsed > args.delay + args.slack:
+      errors.append(f'{name} took {elapsed:.3f}s, expected about {args.delay}s')
+  return {name : elapsed for name, (ret, elapsed) in results.items()}, errors
+
+def main():
+  parser = argparse.ArgumentParser(description='Checks that waiting actions wake up, time out and cancel in time')
+  parser.add_argument('--delay', type=float, default=0.2, help='Seconds until the awaited event (or timeout, or cancel) happens')
+  parser.add_argument('--slack', type=float, default=0.2, help='How much longer than that a wait may take')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.ERROR)
+
+  ep = LocalEndpoint('local')
+  windows, errors = check_windows(args, ep)
+  devices, more = check_audio(args, ep)
+  errors += more
+
+  print(json.dumps({
+    'benchmark' : 'waiters',
+    'windows' : windows,
+    'audio' : devices,
+    'errors' : errors,
+  }, indent=2))
+  sys.exit(1 if errors else 0)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,92 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+import threading
+from contextlib import contextmanager
+
+class Cancelled(Exception):
+  pass
+
+class CancelToken:
+  ''' Tells a running sequence of actions to give up
+
+  Delays and waits performed while a token is active (see activate())
+  end as soon as it's cancelled.
+  '''
+  def __init__(self):
+    self.event = threading.Event()
+    self.callbacks = []
+    self.lock = threading.Lock()
+
+  def cancel(self):
+    with self.lock:
+      if self.event.is_set():
+        return
+      self.event.set()
+      callbacks = list(self.callbacks)
+    for callback in callbacks:
+      callback()
+
+  def cancelled(self):
+    return self.event.is_set()
+
+  def check(self):
+    if self.event.is_set():
+      raise Cancelled()
+
+  def sleep(self, duration):
+    ''' Sleeps for duration seconds, raising Cancelled if cancelled meanwhile '''
+    if self.event.wait(duration):
+      raise Cancelled()
+
+  def onCancel(self, callback):
+    ''' Calls callback when cancelled, returns a function undoing this '''
+    with self.lock:
+      if not self.event.is_set():
+        self.callbacks.append(callback)
+        return lambda: self._remove(callback)
+    callback()
+    return lambda: None
+
+  def _remove(self, callback):
+    with self.lock:
+      if callback in self.callbacks:
+        self.callbacks.remove(callback)
+
+# Used when nothing is active, never gets cancelled
+NEVER = CancelToken()
+
+_local = threading.local()
+
+def current():
+  return getattr(_local, 'token', NEVER)
+
+@contextmanager
+def activate(token):
+  ''' Makes token the current one for this thread (None for NEVER) '''
+  previous = current()
+  _local.token = token or NEVER
+  try:
+    yield
+  finally:
+    _local.token = previous
+
+def bind(func):
+  ''' Wraps func so it runs with the caller's token, even on another thread '''
+  token = current()
+  def bound(*args, **kwargs):
+    with activate(token):
+      return func(*args, **kwargs)
+  return bound
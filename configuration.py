@@ -14,16 +14,29 @@
 # along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
 #
 import os
+import json
+import time
 import yaml
 import logging
+from threading import Thread
 
 from programs import ProgramManager, Action
+from endpoints import FanoutEndpoint
+from actiongraph import GraphError
+from templates import TemplateCache
+from windowevents import WindowRegistry
 
 class Config:
-  def __init__(self):
+  # Bumped whenever the layout of the parsed configuration changes
+  CACHE_VERSION = 3
+
+  def __init__(self, cache=None):
     self.LOWLEVEL_TOKEN = None
     self.pm = None
     self.secrets = {}
+    self.spec = None
+    self.cache = cache
+    self.templates = TemplateCache()
 
   def getToken(self):
     return self.LOWLEVEL_TOKEN
@@ -31,18 +44,117 @@ class Config:
   def getProgramManager(self):
     return self.pm
 
+  def getSettings(self):
+    return self.spec['settings'] if self.spec else {}
+
   def _read_with_substitution(self, file, subst):
-    if os.path.exists(file):
-      with open(file) as f:
-        txt = f.read()
-        data = yaml.safe_load(txt.format_map(subst))
-        return data
-    return {}
+    template = self.templates.get(file)
+    if template is None:
+      return {}
+    return template.render(subst)
 
-  def load(self):
-    # Wipe out existing configuration
-    self.pm = ProgramManager()
-    self.secrets = {}
+  def _endpoint_settings(self, entry):
+    settings = {}
+    timeout = entry.get('timeout', None)
+    if isinstance(timeout, dict):
+      if 'connect' in timeout:
+        settings['connect_timeout'] = timeout['connect']
+      if 'read' in timeout:
+        settings['read_timeout'] = timeout['read']
+    elif timeout is not None:
+      settings['connect_timeout'] = timeout
+      settings['read_timeout'] = timeout
+    if 'retries' in entry:
+      settings['retries'] = int(entry['retries'])
+    if 'batch' in entry:
+      settings['batching'] = bool(entry['batch'])
+    if 'failures' in entry:
+      settings['failures'] = int(entry['failures'])
+    if 'cooldown' in entry:
+      settings['cooldown'] = float(entry['cooldown'])
+    return settings
+
+  def _members(self, members, what):
+    ''' Checks that members only lists endpoints (and not groups) '''
+    for member in members:
+      endpoint = self.pm.getEndpoint(member)
+      if not endpoint:
+        logging.error(f'endpoint "{member}" isn\'t available ({what})')
+        return False
+      if isinstance(endpoint, FanoutEndpoint):
+        logging.error(f'"{member}" is a group, groups can\'t be part of other groups ({what})')
+        return False
+    return True
+
+  def _action_endpoint(self, item, name):
+    ''' Finds the endpoint of an action, a list of endpoints becomes a group of its own '''
+    target = item.get('endpoint', 'local')
+    if not isinstance(target, list):
+      endpoint = self.pm.getEndpoint(str(target).lower())
+      if not endpoint:
+        logging.error(f"endpoint \"{str(target).lower()}\" isn't available (program \"{name}\")")
+      return endpoint
+    members = [str(member).lower() for member in target]
+    policy = str(item.get('policy', FanoutEndpoint.ALL)).lower()
+    if policy not in FanoutEndpoint.POLICIES:
+      logging.error(f"policy must be one of {', '.join(FanoutEndpoint.POLICIES)}, not \"{policy}\" (program \"{name}\")")
+      return None
+    if not members or not self._members(members, f'program "{name}"'):
+      return None
+    group = '+'.join(members) + ('' if policy == FanoutEndpoint.ALL else f' ({policy})')
+    return self.pm.createGroup(group, members, policy)
+
+  def _add_actions(self, prg, name, items, methods, addFunc, kind):
+    for item in items:
+      method = item.get('method', '').lower()
+      arguments = item.get('arguments', [])
+      options = item.get('options', None)
+      after = item.get('after', None)
+      ifdown = str(item.get('ifdown', Action.IFDOWN_FAIL)).lower()
+      if method not in methods:
+        logging.error(f"{method} isn't a supported {kind} method (program \"{name}\")")
+        continue
+      endpoint = self._action_endpoint(item, name)
+      if not endpoint:
+        continue
+      if ifdown not in Action.IFDOWN:
+        logging.error(f"ifdown must be one of {', '.join(Action.IFDOWN)}, not \"{ifdown}\" (program \"{name}\")")
+        continue
+      if not isinstance(arguments, list):
+        arguments = [arguments]
+      if options and 'match' in options:
+        problem = WindowRegistry.invalid(str(arguments[0]) if arguments else '', options['match'])
+        if problem:
+          logging.error(f'{problem} (program "{name}")')
+          continue
+      if after is not None and not isinstance(after, list):
+        after = [after]
+      action = addFunc(endpoint, method, *arguments)
+      if options:
+        action.setOptions(options)
+      action.setIfDown(ifdown)
+      if 'name' in item or after is not None:
+        action.setDependencies(item.get('name', None), after)
+
+  def _mtime(self, file):
+    try:
+      return os.path.getmtime(file)
+    except OSError:
+      return None
+
+  def _parse(self):
+    ''' Reads all configuration files into a plain description of the setup '''
+    spec = {
+      'token' : None,
+      'secrets' : {},
+      'settings' : {},
+      'endpoints' : {},
+      'groups' : {},
+      'programs' : {},
+      'files' : {'secrets.yml' : self._mtime('secrets.yml'), 'config.yml' : self._mtime('config.yml')},
+      # False if config.yml was missing or empty
+      'loaded' : False,
+    }
 
     # First, load all secrets (if any)
     if os.path.exists('secrets.yml'):
@@ -51,75 +163,256 @@ class Config:
         if 'secrets' in data and not isinstance(data['secrets'], dict):
           logging.error('secrets is not a dict')
         elif 'secrets' in data:
-          self.secrets = data['secrets']
+          spec['secrets'] = data['secrets']
 
-        self.LOWLEVEL_TOKEN = data.get('token', None)
+        spec['token'] = data.get('token', None)
     else:
       logging.warning('You don\'t have a secrets.yml, please don\'t put your secrets in the config.yml')
 
-    if not self.LOWLEVEL_TOKEN:
+    if not spec['token']:
       logging.warning('Without token defined in secrets.yml, the REST endpoints are disabled.')
 
-    data = self._read_with_substitution('config.yml', self.secrets)
-    if data:
-      if 'endpoints' in data:
-        # Create end-points
-        for name in data['endpoints']:
-          if 'url' in data['endpoints'][name] and 'token' in data['endpoints'][name]:
-            self.pm.createEndpoint(name.lower(), data['endpoints'][name]['url'], data['endpoints'][name]['token'])
-          else:
-            logging.error(f'Endpoint "{name}" cannot be created since it\'s missing url, token or both')
-
-      for name in data.get('programs', {}):
-
-        # Make sure we substitute this entry with the included one if defined
-        if 'include' in data['programs'][name]:
-          replace = self._read_with_substitution(
-            data['programs'][name]['include'],
-            data['programs'][name].get('parameters', {})
-          )
-          if not replace:
-            logging.error(f'File {data["programs"][name]["include"]} is missing or corrupt')
-            continue
-          data['programs'][name] = replace
-
-        if 'start' not in data['programs'][name] and 'stop' not in data['programs'][name]:
-          logging.error(f'Program "{name}" doesn\'t have any defined actions')
+    data = self._read_with_substitution('config.yml', spec['secrets'])
+    if not data:
+      logging.error('No "config.yml" found')
+      return spec
+
+    spec['loaded'] = True
+    spec['settings'] = data.get('options') or {}
+    for name in data.get('endpoints', None) or {}:
+      if 'url' in data['endpoints'][name] and 'token' in data['endpoints'][name]:
+        spec['endpoints'][name.lower()] = data['endpoints'][name]
+      else:
+        logging.error(f'Endpoint "{name}" cannot be created since it\'s missing url, token or both')
+
+    for name in data.get('groups', None) or {}:
+      group = data['groups'][name]
+      if isinstance(group, list):
+        group = {'endpoints' : group}
+      if not isinstance(group, dict) or not isinstance(group.get('endpoints', None), list) or not group['endpoints']:
+        logging.error(f'Group "{name}" cannot be created since it doesn\'t list any endpoints')
+        continue
+      spec['groups'][name.lower()] = {
+        'endpoints' : [str(member).lower() for member in group['endpoints']],
+        'policy' : str(group.get('policy', FanoutEndpoint.ALL)).lower(),
+      }
+
+    for name in data.get('programs', None) or {}:
+      program = data['programs'][name]
+
+      # Make sure we substitute this entry with the included one if defined
+      if 'include' in program:
+        spec['files'][program['include']] = self._mtime(program['include'])
+        replace = self._read_with_substitution(program['include'], program.get('parameters', {}))
+        if not replace:
+          logging.error(f'File {program["include"]} is missing or corrupt')
           continue
+        program = replace
 
-        prg = self.pm.createProgram(name)
-        for item in data['programs'][name].get('start', []):
-          endpoint = self.pm.getEndpoint(item.get('endpoint', 'local').lower())
-          method = item.get('method', '').lower()
-          arguments = item.get('arguments', [])
-          options = item.get('options', None)
-          if method not in Action.METHOD_START:
-            logging.error(f"{method} isn't a supported start method (program \"{data['programs'][name]}\")")
-            continue
-          if not endpoint:
-            logging.error(f"endpoint \"{item.get('endpoint', 'local').lower()}\" isn't available (program \"{data['programs'][name]}\")")
-            continue
-          if not isinstance(arguments, list):
-            arguments = [arguments]
-          action = prg.addStartAction(endpoint, method, *arguments)
-          if options:
-            action.setOptions(options)
-
-        for item in data['programs'][name].get('stop', []):
-          endpoint = self.pm.getEndpoint(item.get('endpoint', 'local').lower())
-          method = item.get('method', '').lower()
-          arguments = item.get('arguments', [])
-          options = item.get('options', None)
-          if method not in Action.METHOD_STOP:
-            logging.error(f"{method} isn't a supported stop method (program \"{data['programs'][name]}\")")
-            continue
-          if not endpoint:
-            logging.error(f"endpoint \"{item.get('endpoint', 'local').lower()}\" isn't available (program \"{data['programs'][name]}\")")
-            continue
-          if not isinstance(arguments, list):
-            arguments = [arguments]
-          action = prg.addStopAction(endpoint, method, *arguments)
-          if options:
-            action.setOptions(options)
-    else:
-      logging.error('No "config.yml" found')
+      if 'start' not in program and 'stop' not in program:
+        logging.error(f'Program "{name}" doesn\'t have any defined actions')
+        continue
+      spec['programs'][name] = program
+    return spec
+
+  def _cached(self):
+    ''' Returns the parsed configuration saved earlier, if none of its files changed since '''
+    if not self.cache or not os.path.exists(self.cache):
+      return None
+    try:
+      with open(self.cache) as f:
+        cached = json.load(f)
+    except:
+      logging.exception(f'Unable to read {self.cache}, parsing the configuration instead')
+      return None
+    if cached.get('version', None) != Config.CACHE_VERSION:
+      return None
+    spec = cached.get('spec', None) or {}
+    if not spec.get('files', None) or any(self._mtime(file) != mtime for file, mtime in spec['files'].items()):
+      return None
+    # The secrets aren't saved, they're already substituted where used
+    spec['secrets'] = {}
+    logging.debug(f'Using the configuration cached in {self.cache}')
+    return spec
+
+  def _save(self, spec):
+    ''' Saves the parsed configuration, which holds the token and credentials, readable by its owner only '''
+    spec = {key : value for key, value in spec.items() if key != 'secrets'}
+    try:
+      fd = os.open(self.cache + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+      # A leftover file keeps whatever permissions it had
+      os.chmod(self.cache + '.tmp', 0o600)
+      with os.fdopen(fd, 'w') as f:
+        json.dump({'version' : Config.CACHE_VERSION, 'spec' : spec}, f)
+      os.replace(self.cache + '.tmp', self.cache)
+    except:
+      logging.exception(f'Unable to save the configuration to {self.cache}')
+
+  def _load_spec(self):
+    ''' Parses the configuration files, unless the cache has them already '''
+    spec = self._cached()
+    if spec is None:
+      spec = self._parse()
+      if self.cache:
+        self._save(spec)
+    return spec
+
+  def _build_endpoint(self, name, entry):
+    self.pm.createEndpoint(name, entry['url'], entry['token'], **self._endpoint_settings(entry))
+
+  def _build_group(self, name, entry):
+    if self.pm.getEndpoint(name):
+      logging.error(f'Group "{name}" has the same name as an endpoint')
+    elif entry['policy'] not in FanoutEndpoint.POLICIES:
+      logging.error(f"Group \"{name}\" policy must be one of {', '.join(FanoutEndpoint.POLICIES)}, not \"{entry['policy']}\"")
+    elif self._members(entry['endpoints'], f'group "{name}"'):
+      self.pm.createGroup(name, entry['endpoints'], entry['policy'])
+
+  def _build_program(self, name, data):
+    prg = self.pm.createProgram(name)
+    self._add_actions(prg, name, data.get('start', None) or [], Action.METHOD_START, prg.addStartAction, 'start')
+    self._add_actions(prg, name, data.get('stop', None) or [], Action.METHOD_STOP, prg.addStopAction, 'stop')
+    try:
+      prg.validate()
+    except GraphError as e:
+      logging.error(f'Program "{name}" has invalid step dependencies: {e}')
+      self.pm.removeProgram(name)
+      return
+    if data.get('prewarm', None):
+      self._set_prewarm(prg, data['prewarm'])
+    if data.get('resources', None) is not None:
+      self._set_resources(prg, data['resources'])
+
+  def _set_resources(self, prg, resources):
+    # A single resource or a list of them, an empty list shares everything
+    if not isinstance(resources, list):
+      resources = [resources]
+    if not all(isinstance(resource, str) and resource for resource in resources):
+      logging.error(f'Program "{prg.name}" resources must be names like "display" or "audio@remote", it will conflict with every program')
+      return
+    prg.setResources(resources)
+
+  def _set_prewarm(self, prg, prewarm):
+    # Either true, a list of actions or the full section
+    if isinstance(prewarm, list):
+      prewarm = {'actions' : prewarm}
+    elif not isinstance(prewarm, dict):
+      prewarm = {}
+    actions = prewarm.get('actions', None)
+    skip = prewarm.get('skip', None)
+    if actions is not None and not isinstance(actions, list):
+      actions = [actions]
+    if skip is not None and not isinstance(skip, list):
+      skip = [skip]
+    if not prg.setPrewarm(actions, prewarm.get('window', 'minimized'), skip):
+      logging.error(f'Program "{prg.name}" will not be prewarmed')
+
+  def _program_endpoints(self, data):
+    items = (data.get('start', None) or []) + (data.get('stop', None) or [])
+    names = set()
+    for item in items:
+      target = item.get('endpoint', 'local')
+      names.update(str(member).lower() for member in (target if isinstance(target, list) else [target]))
+    return names
+
+  def load(self):
+    # Wipe out existing configuration
+    spec = self._load_spec()
+    self.secrets = spec['secrets']
+    self.LOWLEVEL_TOKEN = spec['token']
+    self.pm = ProgramManager(workers=spec['settings'].get('workers', 4))
+    for name, entry in spec['endpoints'].items():
+      self._build_endpoint(name, entry)
+    for name, entry in spec['groups'].items():
+      self._build_group(name, entry)
+    for name, data in spec['programs'].items():
+      self._build_program(name, data)
+    self.pm.setPrewarmPolicy(spec['settings'].get('prewarm', None))
+    self.spec = spec
+
+  def reload(self):
+    ''' Applies changes in the configuration files to the running setup
+
+    Only endpoints and programs whose definition changed are rebuilt. The
+    active program keeps running as it was started (along with any PIDs
+    it tracks) and picks up its new definition the next time it starts.
+    Changes are applied in turn with program switches, never in between.
+    Should config.yml be missing or empty (like while it's being saved),
+    the current setup is kept.
+    '''
+    if self.pm is None:
+      return self.load()
+
+    spec = self._load_spec()
+    if not spec['loaded']:
+      logging.error('Keeping the current configuration until "config.yml" can be read')
+      # Try again once the files change, not on every check
+      self.spec = {**self.spec, 'files' : spec['files']}
+      return
+    self.pm.run(self._apply, self.spec, spec)
+
+  def _apply(self, old, new):
+    self.secrets = new['secrets']
+    self.LOWLEVEL_TOKEN = new['token']
+    if new['settings'].get('workers', 4) != old['settings'].get('workers', 4):
+      logging.warning('Changing the number of workers requires a restart')
+
+    endpoints = set()
+    for name in set(old['endpoints']) | set(new['endpoints']):
+      if old['endpoints'].get(name, None) == new['endpoints'].get(name, None):
+        continue
+      logging.info(f'Endpoint "{name}" changed')
+      endpoints.add(name)
+      self.pm.removeEndpoint(name)
+      if name in new['endpoints']:
+        self._build_endpoint(name, new['endpoints'][name])
+
+    for name in set(old['groups']) | set(new['groups']):
+      entry = new['groups'].get(name, None)
+      if old['groups'].get(name, None) == entry and not (endpoints & set(entry['endpoints'])):
+        continue
+      logging.info(f'Group "{name}" changed')
+      endpoints.add(name)
+      self.pm.removeEndpoint(name)
+      if entry is not None:
+        self._build_group(name, entry)
+
+    for name in set(old['programs']) | set(new['programs']):
+      data = new['programs'].get(name, None)
+      if old['programs'].get(name, None) == data and not (endpoints & self._program_endpoints(data or {})):
+        continue
+      if name in self.pm.getActivePrograms():
+        logging.info(f'Program "{name}" is active, changes take effect next time it starts')
+      elif data is None:
+        logging.info(f'Program "{name}" removed')
+      else:
+        logging.info(f'Program "{name}" changed')
+      self.pm.removeProgram(name)
+      if data is not None:
+        self._build_program(name, data)
+
+    # Rebuilt programs start out cold
+    self.pm.setPrewarmPolicy(new['settings'].get('prewarm', None))
+    self.spec = new
+
+  def hasChanged(self):
+    ''' True if any of the files the configuration was read from changed '''
+    return any(self._mtime(file) != mtime for file, mtime in self.spec['files'].items())
+
+class ConfigWatcher(Thread):
+  ''' Reloads the configuration whenever one of its files changes '''
+  def __init__(self, config, interval=2):
+    Thread.__init__(self)
+    self.config = config
+    self.interval = interval
+    self.daemon = True
+
+  def run(self):
+    while True:
+      time.sleep(self.interval)
+      try:
+        if self.config.hasChanged():
+          logging.info('Configuration changed, reloading')
+          self.config.reload()
+      except:
+        logging.exception('Failed to reload configuration')
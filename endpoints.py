@@ -13,26 +13,215 @@
 # You should have received a copy of the GNU General Public License
 # along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
 #
+import os
+import socket
 import subprocess
-import psutil
-import win32gui
-import win32api
-import win32con
-import requests
-import win32com.client
-import pythoncom
-import logging
 import time
-from pycaw.pycaw import AudioUtilities
+import logging
+import ctypes
+from ctypes import wintypes
+from threading import Thread, Lock, Event, local
+from concurrent.futures import Future
+
+from lazyimport import lazy_import
+# These are slow to load, so they're only imported once an action needs them
+psutil = lazy_import('psutil')
+win32gui = lazy_import('win32gui')
+win32api = lazy_import('win32api')
+win32con = lazy_import('win32con')
+win32process = lazy_import('win32process')
+win32com_client = lazy_import('win32com.client')
+pythoncom = lazy_import('pythoncom')
+requests = lazy_import('requests')
+requests_adapters = lazy_import('requests.adapters')
+urllib3_retry = lazy_import('urllib3.util.retry')
+pycaw = lazy_import('pycaw.pycaw')
+pycaw_callbacks = lazy_import('pycaw.callbacks')
+
+import audio
+import cancellation
+import health
+import metrics
+import tracing
+import windowevents
+import processes
+from windowevents import WindowBackend, WindowRegistry
+
+# How long the wait methods wait unless told otherwise with maxwait
+WAIT_MAXWAIT = 30
+# Seconds between scans for a process to appear
+WAIT_RESCAN = 0.5
+
+# What each step of an input sequence may contain
+INPUT_STEPS = {'keys', 'move', 'click', 'count', 'delay'}
+
+def maxwait(method, options, arguments=()):
+  ''' How long a call may wait on the endpoint, given its options and arguments '''
+  default = WAIT_MAXWAIT if method.startswith('wait ') else 0
+  wait = float((options or {}).get('maxwait', default))
+  if method == 'delay' and arguments:
+    wait += float(arguments[0])
+  elif method == 'input sequence':
+    wait += sum(float(step.get('delay', 0)) for step in arguments if isinstance(step, dict))
+  return wait
+
+def may_wait(method, options, arguments=()):
+  ''' True if a call may wait on the endpoint, maybe without a limit '''
+  options = options or {}
+  return maxwait(method, options, arguments) > 0 or bool(options.get('waitforit', False) or options.get('whenactive', False))
+
+_input = local()
+
+def shell():
+  ''' The WScript.Shell of the calling thread, so COM is only set up once per thread '''
+  if getattr(_input, 'shell', None) is None:
+    pythoncom.CoInitialize()
+    _input.shell = win32com_client.Dispatch("WScript.Shell")
+  return _input.shell
+
+def click(button, count=1):
+  ''' Clicks where the mouse is, each click as a single press and release event '''
+  flags = win32con.MOUSEEVENTF_RIGHTDOWN | win32con.MOUSEEVENTF_RIGHTUP if button == 'right' else win32con.MOUSEEVENTF_LEFTDOWN | win32con.MOUSEEVENTF_LEFTUP
+  for i in range(0, count):
+    win32api.mouse_event(flags, 0, 0, 0, 0)
+
+class Win32WindowBackend(WindowBackend):
+  ''' Windows backend, listening for window events through a WinEvent hook '''
+  EVENTS = {
+    0x0003 : WindowBackend.FOREGROUND,  # EVENT_SYSTEM_FOREGROUND
+    0x0016 : WindowBackend.MINIMIZED,   # EVENT_SYSTEM_MINIMIZESTART
+    0x0017 : WindowBackend.RESTORED,    # EVENT_SYSTEM_MINIMIZEEND
+    0x8000 : WindowBackend.CREATED,     # EVENT_OBJECT_CREATE
+    0x8001 : WindowBackend.DESTROYED,   # EVENT_OBJECT_DESTROY
+    0x8002 : WindowBackend.SHOWN,       # EVENT_OBJECT_SHOW
+    0x8003 : WindowBackend.HIDDEN,      # EVENT_OBJECT_HIDE
+    0x800C : WindowBackend.RENAMED,     # EVENT_OBJECT_NAMECHANGE
+  }
+  RANGES = [(0x0003, 0x0003), (0x0016, 0x0017), (0x8000, 0x8003), (0x800C, 0x800C)]
+
+  def start(self, notify):
+    self.notify = notify
+    Thread(target=self._hook, name='winevents', daemon=True).start()
+
+  def _hook(self):
+    user32 = ctypes.windll.user32
+    WinEventProc = ctypes.WINFUNCTYPE(
+      None, wintypes.HANDLE, wintypes.DWORD, wintypes.HWND,
+      wintypes.LONG, wintypes.LONG, wintypes.DWORD, wintypes.DWORD
+    )
+    user32.SetWinEventHook.argtypes = [
+      wintypes.DWORD, wintypes.DWORD, wintypes.HMODULE, WinEventProc,
+      wintypes.DWORD, wintypes.DWORD, wintypes.DWORD
+    ]
+    user32.SetWinEventHook.restype = wintypes.HANDLE
+
+    def callback(hook, event, hwnd, idObject, idChild, thread, timestamp):
+      # Only care about top-level windows themselves, not their contents.
+      # A destroyed window has no ancestry left to check.
+      if idObject != 0 or idChild != 0 or event not in self.EVENTS:
+        return
+      if event != 0x8001 and user32.GetAncestor(hwnd, 2) != hwnd: # GA_ROOT
+        return
+      self.notify(self.EVENTS[event], hwnd)
+
+    # Must stay referenced for as long as the hooks are installed
+    self.callback = WinEventProc(callback)
+    for low, high in self.RANGES:
+      if not user32.SetWinEventHook(low, high, 0, self.callback, 0, 0, 0x0002): # WINEVENT_SKIPOWNPROCESS
+        logging.error(f'Unable to listen for window events {low:#x}-{high:#x}')
+
+    msg = wintypes.MSG()
+    while user32.GetMessageW(ctypes.byref(msg), 0, 0, 0) > 0:
+      user32.TranslateMessage(ctypes.byref(msg))
+      user32.DispatchMessageW(ctypes.byref(msg))
+
+  def enumerate(self):
+    handles = []
+    win32gui.EnumWindows(lambda handle, extra: handles.append(handle), None)
+    return handles
+
+  def title(self, handle):
+    if not win32gui.IsWindow(handle):
+      return None
+    return win32gui.GetWindowText(handle)
+
+  def foreground(self):
+    return win32gui.GetForegroundWindow()
+
+  def pid(self, handle):
+    return win32process.GetWindowThreadProcessId(handle)[1]
+
+  def is_visible(self, handle):
+    return win32gui.IsWindowVisible(handle)
+
+  def is_iconic(self, handle):
+    return win32gui.IsIconic(handle)
+
+  def close(self, handle):
+    win32gui.PostMessage(handle, win32con.WM_CLOSE, 0, 0)
+    return True
+
+  def activate(self, handle, maximize=False, restore=False):
+    # Windows only lets the process which got the last input event take
+    # focus, sending a harmless ALT keypress makes that us.
+    shell().SendKeys('%')
+
+    win32gui.ShowWindow(handle, 5)
+    win32gui.SetForegroundWindow(handle)
+    if maximize:
+      win32gui.ShowWindow(handle, 3)
+    elif restore:
+      win32gui.ShowWindow(handle, 9)
+    return True
+
+class PycawAudioBackend(audio.AudioBackend):
+  ''' Audio devices as seen by the Windows core audio API '''
+  def start(self, notify):
+    class Client(pycaw_callbacks.MMNotificationClient):
+      def on_default_device_changed(self, *args):
+        notify()
+
+      def on_device_state_changed(self, *args):
+        notify()
+
+      def on_device_added(self, *args):
+        notify()
+
+      def on_device_removed(self, *args):
+        notify()
+
+    # Keep both around, the notifications stop once they're collected
+    self.client = Client()
+    self.enumerator = pycaw.AudioUtilities.GetDeviceEnumerator()
+    self.enumerator.RegisterEndpointNotificationCallback(self.client)
+
+  def active(self):
+    device = pycaw.AudioUtilities.GetSpeakers()
+    return device.GetState() == 1 # DEVICE_STATE_ACTIVE
 
 class LocalEndpoint:
+  # How the "window" option of execute asks for the first window to be shown
+  SHOW = {
+    'hidden' : 0,     # SW_HIDE
+    'minimized' : 7,  # SW_SHOWMINNOACTIVE
+  }
+
   def __init__(self, name, url = None, token = None):
     self.name = name
 
+  def _startupinfo(self, options):
+    show = LocalEndpoint.SHOW.get(options.get('window', None), None)
+    if show is None or not hasattr(subprocess, 'STARTUPINFO'):
+      return None
+    info = subprocess.STARTUPINFO()
+    info.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    info.wShowWindow = show
+    return info
+
   def execute(self, options, cmdline):
     try:
       logging.debug(f'Starting {cmdline}')
-      ret = subprocess.Popen(cmdline)
+      ret = subprocess.Popen(cmdline, startupinfo=self._startupinfo(options))
       logging.debug(f'Process started, PID = {ret.pid}')
       return ret.pid
     except:
@@ -53,83 +242,97 @@ class LocalEndpoint:
         logging.exception('Unknown error')
     return ret
 
-  def _wait_for_it(self, timeout, checkFunc, userData=None):
+  def reveal(self, options, pid):
+    ''' Shows the windows of a process started hidden or minimized
+
+    Returns False if the process is no longer running.
+    '''
+    if pid <= 0 or not psutil.pid_exists(pid):
+      return False
+    windows = windowevents.watcher(Win32WindowBackend)
+    for handle in windows.owned(pid):
+      windows.activate(handle, options.get('maximize', False), True)
+    return True
+
+  def _wait_for_it(self, timeout, checkFunc):
+    token = cancellation.current()
     timer = 0
-    result = checkFunc(userData)
+    result = checkFunc()
     while not result:
-      time.sleep(0.1)
+      token.sleep(0.1)
       timer += 0.1
       if timeout > 0 and timer >= timeout:
         break
-      result = checkFunc(userData)
+      result = checkFunc()
     return result
 
-  def _hasAudio(self):
-    try:
-      device = AudioUtilities.GetSpeakers()
-      if device.GetState() != 1:
-        # Current default audio device is not active
-        return False
-      return True
-    except:
-      # No default audio path available
-      return False
+  def _locate_window(self, options, window, whenactive=True):
+    windows = windowevents.watcher(Win32WindowBackend)
+    maxwait = float(options.get('maxwait', 0))
+    match = options.get('match', WindowRegistry.EXACT)
+    problem = WindowRegistry.invalid(window, match)
+    if problem:
+      logging.error(f'Cannot look for window: {problem}')
+      return 0
+
+    handle = windows.find(window, match)
+    if not handle and options.get('waitforit', False):
+      logging.info(f'Waiting for "{window}" to appear')
+      handle = windows.wait(lambda: windows.find(window, match), maxwait)
+      if not handle:
+        logging.info(f'Timed out waiting for window "{window}" to appear.')
+
+    if handle and whenactive and options.get('whenactive', False):
+      logging.info(f'Waiting for "{window}" to become the active window')
+      if not windows.wait(lambda: windows.foreground() == handle, maxwait):
+        logging.info(f'Timed out waiting for window "{window}" to get focus.')
+        handle = 0
+
+    if handle and options.get('whenvisible', False):
+      logging.info(f'Waiting for "{window}" to become visible')
+      if not windows.wait(lambda: windows.is_visible(handle), maxwait):
+        logging.info(f'Timed out waiting for window "{window}" to become visible.')
+        handle = 0
+
+    if handle and options.get('wheniconic', False):
+      logging.info(f'Waiting for "{window}" to be iconic (minimized)')
+      if not windows.wait(lambda: windows.is_iconic(handle), maxwait):
+        logging.info(f'Timed out waiting for window "{window}" to become iconic.')
+        handle = 0
+    return handle
 
   def close_window(self, options, window=None):
     ret = False
     logging.debug(f'close_window({window})')
+    windows = windowevents.watcher(Win32WindowBackend)
     if window:
-      handle = win32gui.FindWindow(None, window)
-      if not handle and options.get('waitforit', False):
-        logging.info(f'Waiting for "{window}" to appear')
-        handle = self._wait_for_it(options.get('maxwait', 0), lambda wnd: win32gui.FindWindow(None, wnd), window)
-        if not handle:
-          logging.info(f'Timed out waiting for window "{window}" to appear.')
-
-      if handle and options.get('whenactive', False):
-        logging.info(f'Waiting for "{window}" to become the active window')
-        if not self._wait_for_it(options.get('maxwait', 0), lambda wnd: win32gui.GetForegroundWindow() == wnd, window):
-          logging.info(f'Timed out waiting for window "{window}" to get focus.')
-          handle = 0
-
-      if handle and options.get('whenvisible', False):
-        logging.info(f'Waiting for "{window}" to become visible')
-        if not self._wait_for_it(options.get('maxwait', 0), win32gui.IsWindowVisible, window):
-          logging.info(f'Timed out waiting for window "{window}" to become visible.')
-          handle = 0
-
-      if handle and options.get('wheniconic', False):
-        logging.info(f'Waiting for "{window}" to be iconic (minimized)')
-        if not self._wait_for_it(options.get('maxwait', 0), win32gui.IsIconic, window):
-          logging.info(f'Timed out waiting for window "{window}" to become iconic.')
-          handle = 0
+      handle = self._locate_window(options, window)
     else:
-      handle = win32gui.GetForegroundWindow()
+      handle = windows.foreground()
 
     if handle:
-      win32gui.PostMessage(handle, win32con.WM_CLOSE, 0, 0)
+      windows.close(handle)
       ret = True
     else:
       logging.warning(f'Cannot find window "{window}"')
     return ret
 
-  def kill_app(self, options, appname):
-    ret = False
-    logging.debug(f'kill_app({appname})')
-    for proc in psutil.process_iter(['pid', 'name', 'username', 'ppid']):
-      try:
-        if proc.name() == appname:
-          logging.debug(f'Found {proc.info}, proceeding to killing it')
-          ret = ret | self.kill_pid(proc.pid)
-      except:
-        logging.debug('Permission denied when inspecting a process, skipping')
-        pass # c'est la vie
-    return ret
+  def windows(self, options):
+    ''' Lists all top-level windows with a title '''
+    return windowevents.watcher(Win32WindowBackend).snapshot()
+
+  def kill_app(self, options, *appnames):
+    logging.debug(f'kill_app({appnames})')
+    table = processes.table()
+    procs = table.find(appnames, refresh=options.get('refresh', False))
+    if not procs:
+      logging.debug(f'No processes matching {appnames}')
+      return False
+    gone = table.terminate(procs, timeout=float(options.get('timeout', 3)), force=options.get('force', True))
+    return len(gone) > 0
 
   def sendkeys(self, options, keys):
-    pythoncom.CoInitialize()
-    shell = win32com.client.Dispatch("WScript.Shell")
-    shell.SendKeys(keys)
+    shell().SendKeys(keys)
     return True
 
   def focus(self, options, window):
@@ -137,39 +340,10 @@ class LocalEndpoint:
     handle = 0
 
     if window:
-      handle = win32gui.FindWindow(None, window)
-      if not handle and options.get('waitforit', False):
-        logging.info(f'Waiting for "{window}" to appear')
-        handle = self._wait_for_it(options.get('maxwait', 0), lambda wnd: win32gui.FindWindow(None, wnd), window)
-        if not handle:
-          logging.info(f'Timed out waiting for window "{window}" to appear.')
-
-      if handle and options.get('whenvisible', False):
-        logging.info(f'Waiting for "{window}" to become visible')
-        if not self._wait_for_it(options.get('maxwait', 0), win32gui.IsWindowVisible, window):
-          logging.info(f'Timed out waiting for window "{window}" to become visible.')
-          handle = 0
-
-      if handle and options.get('wheniconic', False):
-        logging.info(f'Waiting for "{window}" to be iconic (minimized)')
-        if not self._wait_for_it(options.get('maxwait', 0), win32gui.IsIconic, window):
-          logging.info(f'Timed out waiting for window "{window}" to become iconic.')
-          handle = 0
+      handle = self._locate_window(options, window, whenactive=False)
 
     if handle:
-      pythoncom.CoInitialize()
-      #shell = win32com.client.Dispatch("WScript.Shell")
-      #shell.SendKeys(keys)
-
-      shell = win32com.client.Dispatch("WScript.Shell")
-      shell.SendKeys('%')
-
-      win32gui.ShowWindow(handle, 5)
-      win32gui.SetForegroundWindow(handle)
-      if options.get('maximize', False):
-        win32gui.ShowWindow(handle, 3)
-      elif options.get('restore', False):
-        win32gui.ShowWindow(handle, 9)
+      windowevents.watcher(Win32WindowBackend).activate(handle, options.get('maximize', False), options.get('restore', False))
       ret = True
     else:
       logging.warning(f'Cannot find window "{window}"')
@@ -177,41 +351,295 @@ class LocalEndpoint:
 
   def mouse_move(self, options, x, y):
     win32api.SetCursorPos((x,y))
-    leftclicks = options.get('leftclick', 0)
-    rightclicks = options.get('rightclick', 0)
-    for i in range(0, leftclicks):
-      win32api.mouse_event(win32con.MOUSEEVENTF_LEFTUP,x,y,0,0)
-      win32api.mouse_event(win32con.MOUSEEVENTF_LEFTDOWN,x,y,0,0)
-      win32api.mouse_event(win32con.MOUSEEVENTF_LEFTUP,x,y,0,0)
-    for i in range(0, rightclicks):
-      win32api.mouse_event(win32con.MOUSEEVENTF_RIGHTUP,x,y,0,0)
-      win32api.mouse_event(win32con.MOUSEEVENTF_RIGHTDOWN,x,y,0,0)
-      win32api.mouse_event(win32con.MOUSEEVENTF_RIGHTUP,x,y,0,0)
+    click('left', options.get('leftclick', 0))
+    click('right', options.get('rightclick', 0))
     return True
 
+  def input_sequence(self, options, *steps):
+    ''' Plays back keystrokes, mouse moves, clicks and delays in one go '''
+    for step in steps:
+      if not isinstance(step, dict) or not step or not set(step) <= INPUT_STEPS:
+        logging.error(f'Invalid input step {step}, steps may contain {", ".join(sorted(INPUT_STEPS))}')
+        return False
+    token = cancellation.current()
+    for step in steps:
+      token.check()
+      if 'move' in step:
+        x, y = step['move']
+        win32api.SetCursorPos((int(x), int(y)))
+      if 'click' in step:
+        click(step['click'], int(step.get('count', 1)))
+      if 'keys' in step:
+        shell().SendKeys(step['keys'])
+      if 'delay' in step:
+        token.sleep(float(step['delay']))
+    return True
+
+  def _wait_for(self, what, options, checkFunc):
+    if self._wait_for_it(float(options.get('maxwait', WAIT_MAXWAIT)), checkFunc):
+      return True
+    logging.info(f'Timed out waiting for {what}')
+    return False
+
+  def wait_process(self, options, *appnames):
+    ''' Waits for any of the processes to run, or with the exit option for all of them to be gone '''
+    table = processes.table()
+    if options.get('exit', False):
+      # Only the processes running now are waited for, checking on those is cheap
+      running = table.find(appnames, refresh=True)
+      return self._wait_for(f'{appnames} to exit', options, lambda: not any(proc.is_running() for proc in running))
+
+    # Scanning all processes is expensive, so don't do it on every check
+    scanned = 0
+    def started():
+      nonlocal scanned
+      if time.monotonic() - scanned < WAIT_RESCAN:
+        return False
+      scanned = time.monotonic()
+      return len(table.find(appnames, refresh=True)) > 0
+    return self._wait_for(f'{appnames} to run', options, started)
+
+  def wait_window(self, options, window):
+    options = dict(options)
+    options['waitforit'] = True
+    options.setdefault('maxwait', WAIT_MAXWAIT)
+    return self._locate_window(options, window) != 0
+
+  def wait_port(self, options, port, host='127.0.0.1'):
+    def accepting():
+      try:
+        socket.create_connection((host, int(port)), timeout=0.5).close()
+        return True
+      except OSError:
+        return False
+    return self._wait_for(f'{host}:{port} to accept connections', options, accepting)
+
+  def wait_file(self, options, path):
+    return self._wait_for(f'{path} to appear', options, lambda: os.path.exists(path))
+
   def delay(self, options, duration):
     duration = float(duration)
     if options.get('orhasaudio', False):
-      if self._wait_for_it(duration, self._hasAudio):
+      if audio.monitor(PycawAudioBackend).wait(duration):
         logging.debug('Audio device available, early end to delay')
     else:
-      time.sleep(duration)
+      cancellation.current().sleep(duration)
     return True
 
+REMOTE_CALLS = metrics.counter('windowopener_remote_calls_total', 'Calls made to remote endpoints, by outcome', ['endpoint', 'method', 'outcome'])
+REMOTE_SECONDS = metrics.histogram('windowopener_remote_call_duration_seconds', 'Round trip time of calls to remote endpoints', ['endpoint', 'method'])
+
 class RemoteEndpoint:
-  def __init__(self, name, url, token):
+  def __init__(self, name, url, token, connect_timeout=5, read_timeout=30, retries=2, pool_size=4, batching=True, failures=3, cooldown=30):
     self.name = name
     self.url = url
     self.token = token
+    self.batching = batching
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.retries = retries
+    self.pool_size = pool_size
+    self.session = None
+    self.lock = Lock()
+    self.breaker = health.CircuitBreaker(name, failures, cooldown)
+    self.latency = None
+    self.average = None
+    self.checks = 0
+    self.missed = 0
+    self.seen = None
+    self.error = None
 
-  def _remote_call(self, method, options, *arguments):
+  def available(self):
+    ''' False while calls to this endpoint fail without being attempted '''
+    return self.breaker.available()
+
+  def ping(self, timeout):
+    ''' Checks if the remote answers, any answer at all counts '''
+    started = time.monotonic()
     try:
-      r = requests.post(f'{self.url}/lowlevel/{method}', json={'arguments': [*arguments], 'options': options, 'token' : self.token})
-      if 'result' in r.json():
-        return r.json()['result']
-    except:
-      logging.exception(f'Remote call to {self.url}/lowlevel/{method} failed')
-    return False
+      # Not through the session, its retries would hide how the remote is doing
+      requests.post(f'{self.url}/lowlevel/ping', json={'token' : self.token}, timeout=timeout)
+    except Exception as e:
+      logging.debug(f'Ping of {self.url} failed: {e}')
+      self.checks += 1
+      self.missed += 1
+      self.error = str(e)
+      self.breaker.failure()
+      return False
+    self.latency = time.monotonic() - started
+    # Smooth out the occasional slow answer
+    self.average = self.latency if self.average is None else 0.8 * self.average + 0.2 * self.latency
+    self.checks += 1
+    self.seen = time.time()
+    self.error = None
+    self.breaker.success()
+    return True
+
+  def health(self):
+    return {
+      'state' : self.breaker.state,
+      'available' : self.available(),
+      'latency' : self.latency,
+      'average' : self.average,
+      'checks' : self.checks,
+      'missed' : self.missed,
+      'seen' : self.seen,
+      'error' : self.error,
+    }
+
+  def _refused(self, method, started, span):
+    logging.error(f'Endpoint "{self.name}" is down, not calling {self.url}/lowlevel/{method}')
+    self._record(method, started, 'down', span)
+
+  def _session(self):
+    # Keep connections to the remote alive between actions. Retries only
+    # cover failing to connect, since a request that made it to the
+    # remote might already have been acted upon.
+    with self.lock:
+      if self.session is None:
+        retry = urllib3_retry.Retry(
+          total=self.retries, connect=self.retries, read=False, status=0, other=0,
+          backoff_factor=0.2, allowed_methods=None
+        )
+        adapter = requests_adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+      return self.session
+
+  def _timeout(self, method, options, arguments=()):
+    # Remote waits are bounded by maxwait, allow for them on top of the read timeout
+    read = self.read_timeout
+    if read is not None:
+      read += maxwait(method, options, arguments)
+    return (self.connect_timeout, read)
+
+  def _record(self, method, started, outcome, span):
+    REMOTE_CALLS.inc(self.name, method, outcome)
+    REMOTE_SECONDS.observe(time.monotonic() - started, self.name, method)
+    if span and outcome != 'success':
+      span['status'] = outcome
+
+  def _payload(self, payload):
+    payload['token'] = self.token
+    trace = tracing.header()
+    if trace:
+      # Have the remote record its side of the trace and send it back
+      payload['trace'] = trace
+    return payload
+
+  def _post(self, url, payload, timeout, waits=False):
+    ''' Posts payload to url, giving up right away if the current start is
+    cancelled while the remote waits. The remote carries on regardless,
+    its answer is ignored.
+    '''
+    token = cancellation.current()
+    if not waits or token is cancellation.NEVER:
+      return self._session().post(url, json=payload, timeout=timeout)
+
+    future = Future()
+    def post():
+      try:
+        future.set_result(self._session().post(url, json=payload, timeout=timeout))
+      except Exception as e:
+        future.set_exception(e)
+    Thread(target=post, daemon=True).start()
+    finished = Event()
+    future.add_done_callback(lambda future: finished.set())
+    undo = token.onCancel(finished.set)
+    try:
+      finished.wait()
+    finally:
+      undo()
+    if not future.done():
+      logging.info(f'Cancelled, no longer waiting for {url}')
+      raise cancellation.Cancelled()
+    return future.result()
+
+  def _remote_call(self, method, options, *arguments):
+    cancellation.current().check()
+    started = time.monotonic()
+    with tracing.span(f'remote {method}', endpoint=self.name) as span:
+      if not self.breaker.allow():
+        self._refused(method, started, span)
+        return False
+      try:
+        try:
+          r = self._post(
+            f'{self.url}/lowlevel/{method}',
+            self._payload({'arguments': [*arguments], 'options': options}),
+            self._timeout(method, options, arguments),
+            waits=may_wait(method, options, arguments)
+          )
+        except (requests.Timeout, requests.ConnectionError):
+          self.breaker.failure()
+          raise
+        self.breaker.success()
+        result = r.json()
+        tracing.merge(result.get('spans', None))
+        if 'result' in result:
+          ret = result['result']
+          self._record(method, started, 'failure' if ret is None or ret is False else 'success', span)
+          return ret
+      except cancellation.Cancelled:
+        self._record(method, started, 'cancelled', span)
+        raise
+      except requests.Timeout:
+        logging.error(f'Remote call to {self.url}/lowlevel/{method} timed out')
+        self._record(method, started, 'timeout', span)
+        return False
+      except requests.ConnectionError as e:
+        logging.error(f'Remote call to {self.url}/lowlevel/{method} failed: {e}')
+      except:
+        logging.exception(f'Remote call to {self.url}/lowlevel/{method} failed')
+      self._record(method, started, 'failure', span)
+      return False
+
+  def batch(self, entries):
+    ''' Runs a list of lowlevel calls on the remote in one request
+
+    Returns the list of results, or None if the remote doesn't support
+    batches (in which case batching is turned off for this endpoint).
+    '''
+    cancellation.current().check()
+    connect, read = self._timeout('batch', None)
+    if read is not None:
+      for entry in entries:
+        read += maxwait(entry['method'], entry['options'], entry['arguments'])
+    started = time.monotonic()
+    with tracing.span('remote batch', endpoint=self.name, actions=len(entries)) as span:
+      if not self.breaker.allow():
+        self._refused('batch', started, span)
+        return [{'result' : False} for entry in entries]
+      try:
+        try:
+          r = self._session().post(
+            f'{self.url}/lowlevel/batch',
+            json=self._payload({'actions': entries}),
+            timeout=(connect, read)
+          )
+        except (requests.Timeout, requests.ConnectionError):
+          self.breaker.failure()
+          raise
+        self.breaker.success()
+        if r.status_code == 404:
+          logging.warning(f'{self.url} does not support batches, sending actions one at a time')
+          self.batching = False
+          return None
+        result = r.json()
+        tracing.merge(result.get('spans', None))
+        self._record('batch', started, 'success', span)
+        return result.get('results', [])
+      except requests.Timeout:
+        logging.error(f'Remote call to {self.url}/lowlevel/batch timed out')
+        self._record('batch', started, 'timeout', span)
+        return [{'result' : False} for entry in entries]
+      except requests.ConnectionError as e:
+        logging.error(f'Remote call to {self.url}/lowlevel/batch failed: {e}')
+      except:
+        logging.exception(f'Remote call to {self.url}/lowlevel/batch failed')
+      self._record('batch', started, 'failure', span)
+      return [{'result' : False} for entry in entries]
 
   def execute(self, options, cmdline):
     logging.debug(f'Starting {cmdline}')
@@ -224,11 +652,17 @@ class RemoteEndpoint:
       return self._remote_call('kill pid', options, pid)
     return False
 
+  def reveal(self, options, pid):
+    return self._remote_call('reveal', options, pid)
+
   def close_window(self, options, window=None):
     return self._remote_call('close window', options, window)
 
-  def kill_app(self, options, appname):
-    return self._remote_call('kill app', options, appname)
+  def windows(self, options):
+    return self._remote_call('windows', options)
+
+  def kill_app(self, options, *appnames):
+    return self._remote_call('kill app', options, *appnames)
 
   def sendkeys(self, options, keys):
     return self._remote_call('sendkeys', options, keys)
@@ -238,3 +672,126 @@ class RemoteEndpoint:
 
   def mouse_move(self, options, x, y):
     return self._remote_call('mouse move', options, x, y)
+
+  def wait_process(self, options, *appnames):
+    return self._remote_call('wait process', options, *appnames)
+
+  def wait_window(self, options, window):
+    return self._remote_call('wait window', options, window)
+
+  def wait_port(self, options, port, host='127.0.0.1'):
+    return self._remote_call('wait port', options, port, host)
+
+  def wait_file(self, options, path):
+    return self._remote_call('wait file', options, path)
+
+  def input_sequence(self, options, *steps):
+    return self._remote_call('input sequence', options, *steps)
+
+class FanoutEndpoint:
+  ''' Carries out each action on several endpoints at the same time
+
+  The action succeeds depending on the policy: when it succeeds on all
+  of them, on any of them or on more than half of them (quorum). Since
+  execute starts a process on each endpoint, it returns a list of PIDs
+  (-1 where it failed) which kill_pid and reveal take as well.
+  '''
+  ALL = 'all'
+  ANY = 'any'
+  QUORUM = 'quorum'
+  POLICIES = [ALL, ANY, QUORUM]
+
+  def __init__(self, name, endpoints, policy, executor):
+    self.name = name
+    self.endpoints = endpoints
+    self.policy = policy
+    self.executor = executor
+
+  def _met(self, successes):
+    if self.policy == FanoutEndpoint.ANY:
+      return successes > 0
+    if self.policy == FanoutEndpoint.QUORUM:
+      return successes > len(self.endpoints) // 2
+    return successes == len(self.endpoints)
+
+  def _succeeded(self, ret):
+    return not (ret is None or ret is False or ret == -1)
+
+  def available(self):
+    return self._met(sum(1 for endpoint in self.endpoints if getattr(endpoint, 'available', lambda: True)()))
+
+  def _fanout(self, calls):
+    ''' Runs calls, one (endpoint, function) pair per endpoint, side by side and returns their results in order '''
+    def call(endpoint, func):
+      try:
+        return func(endpoint)
+      except cancellation.Cancelled:
+        raise
+      except:
+        logging.exception(f'Call to endpoint "{endpoint.name}" failed')
+        return False
+    futures = [self.executor.submit(tracing.bind(cancellation.bind(call)), endpoint, func) for endpoint, func in calls]
+    return [future.result() for future in futures]
+
+  def _call(self, function, options, *arguments):
+    results = self._fanout([(endpoint, lambda endpoint: getattr(endpoint, function)(options, *arguments)) for endpoint in self.endpoints])
+    successes = sum(1 for ret in results if self._succeeded(ret))
+    if not self._met(successes):
+      logging.error(f'{function} succeeded on {successes} of {len(self.endpoints)} endpoints of "{self.name}" (policy {self.policy})')
+      return False
+    return True
+
+  def _pids(self, pid):
+    return pid if isinstance(pid, list) else [pid] * len(self.endpoints)
+
+  def execute(self, options, cmdline):
+    pids = self._fanout([(endpoint, lambda endpoint: endpoint.execute(options, cmdline)) for endpoint in self.endpoints])
+    pids = [pid if self._succeeded(pid) else -1 for pid in pids]
+    successes = sum(1 for pid in pids if pid != -1)
+    if not self._met(successes):
+      logging.error(f'Started {cmdline} on {successes} of {len(self.endpoints)} endpoints of "{self.name}" (policy {self.policy})')
+      # Nothing tracks them once the action failed, so don't leave them behind
+      self.kill_pid(options, pids)
+      return -1
+    return pids
+
+  def kill_pid(self, options, pid):
+    calls = [(endpoint, lambda endpoint, pid=pid: endpoint.kill_pid(options, pid)) for endpoint, pid in zip(self.endpoints, self._pids(pid)) if pid > 0]
+    return any(self._fanout(calls))
+
+  def reveal(self, options, pid):
+    calls = [(endpoint, lambda endpoint, pid=pid: endpoint.reveal(options, pid)) for endpoint, pid in zip(self.endpoints, self._pids(pid))]
+    return self._met(sum(1 for ret in self._fanout(calls) if self._succeeded(ret)))
+
+  def delay(self, options, duration):
+    return self._call('delay', options, duration)
+
+  def close_window(self, options, window=None):
+    return self._call('close_window', options, window)
+
+  def kill_app(self, options, *appnames):
+    return self._call('kill_app', options, *appnames)
+
+  def sendkeys(self, options, keys):
+    return self._call('sendkeys', options, keys)
+
+  def focus(self, options, window):
+    return self._call('focus', options, window)
+
+  def mouse_move(self, options, x, y):
+    return self._call('mouse_move', options, x, y)
+
+  def wait_process(self, options, *appnames):
+    return self._call('wait_process', options, *appnames)
+
+  def wait_window(self, options, window):
+    return self._call('wait_window', options, window)
+
+  def wait_port(self, options, port, host='127.0.0.1'):
+    return self._call('wait_port', options, port, host)
+
+  def wait_file(self, options, path):
+    return self._call('wait_file', options, path)
+
+  def input_sequence(self, options, *steps):
+    return self._call('input_sequence', options, *steps)
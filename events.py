@@ -0,0 +1,110 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+import itertools
+from collections import deque
+from threading import Condition, Lock
+
+class Subscription:
+  ''' Events waiting to be picked up by one subscriber
+
+  Only the most recent "size" events are kept, should the subscriber
+  fall behind the oldest ones are dropped (and counted).
+  '''
+  def __init__(self, size):
+    self.events = deque(maxlen=size)
+    self.dropped = 0
+    self.condition = Condition()
+
+  def put(self, event):
+    with self.condition:
+      if len(self.events) == self.events.maxlen:
+        self.dropped += 1
+      self.events.append(event)
+      self.condition.notify_all()
+
+  def get(self, timeout):
+    ''' Returns all pending events, waiting up to timeout seconds for any '''
+    with self.condition:
+      if not self.events:
+        self.condition.wait(timeout)
+      events = list(self.events)
+      self.events.clear()
+      return events
+
+class EventBus:
+  ''' Hands out events to everyone subscribed at the time '''
+  def __init__(self, size=100):
+    self.size = size
+    self.subscribers = []
+    self.ids = itertools.count(1)
+    self.lock = Lock()
+
+  def subscribe(self):
+    subscription = Subscription(self.size)
+    with self.lock:
+      self.subscribers.append(subscription)
+    return subscription
+
+  def unsubscribe(self, subscription):
+    with self.lock:
+      if subscription in self.subscribers:
+        self.subscribers.remove(subscription)
+
+  def active(self):
+    return len(self.subscribers) > 0
+
+  def publish(self, kind, data):
+    with self.lock:
+      event = (next(self.ids), kind, data)
+      subscribers = list(self.subscribers)
+    for subscription in subscribers:
+      subscription.put(event)
+
+class ProgressEvents:
+  ''' Program listener publishing the progress of every action '''
+  def __init__(self, bus):
+    self.bus = bus
+
+  def _publish(self, program, phase, index, action, state, duration=None, error=None):
+    self.bus.publish('action', {
+      'program' : program.name,
+      'phase' : phase,
+      'index' : index,
+      'method' : action.method,
+      'endpoint' : action.endpoint.name,
+      'state' : state,
+      'duration' : duration,
+      'error' : str(error) if error else None,
+    })
+
+  def actionStarted(self, program, phase, index, action):
+    self._publish(program, phase, index, action, 'running')
+
+  def actionFinished(self, program, phase, index, action, duration, error):
+    self._publish(program, phase, index, action, 'failed' if error else 'done', duration, error)
+
+class Listeners:
+  ''' Program listener passing progress on to several others '''
+  def __init__(self, listeners):
+    self.listeners = [listener for listener in listeners if listener]
+
+  def actionStarted(self, program, phase, index, action):
+    for listener in self.listeners:
+      listener.actionStarted(program, phase, index, action)
+
+  def actionFinished(self, program, phase, index, action, duration, error):
+    for listener in self.listeners:
+      listener.actionFinished(program, phase, index, action, duration, error)
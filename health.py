@@ -0,0 +1,123 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+import time
+import logging
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+
+class CircuitBreaker:
+  ''' Keeps calls away from an endpoint which is down
+
+  After "failures" failed calls in a row the breaker opens and calls
+  fail right away. Once "cooldown" seconds have passed it lets a single
+  call through (half-open), which closes it again if it succeeds.
+  '''
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half-open'
+
+  def __init__(self, name, failures=3, cooldown=30):
+    self.name = name
+    self.failures = failures
+    self.cooldown = cooldown
+    self.state = CircuitBreaker.CLOSED
+    self.count = 0
+    self.opened = 0
+    self.trial = False
+    self.lock = Lock()
+    # Called whenever the state changes
+    self.listener = None
+
+  def _changed(self, before):
+    if self.state != before and self.listener:
+      self.listener()
+
+  def _expired(self):
+    return self.state == CircuitBreaker.OPEN and time.monotonic() - self.opened >= self.cooldown
+
+  def available(self):
+    ''' True unless calls would be turned away right now '''
+    with self.lock:
+      return self.state != CircuitBreaker.OPEN or self._expired()
+
+  def allow(self):
+    ''' Decides if a call may go ahead, counting it as the trial when half-open '''
+    with self.lock:
+      before = self.state
+      if self._expired():
+        self.state = CircuitBreaker.HALF_OPEN
+        self.trial = False
+      allowed = self.state == CircuitBreaker.CLOSED or (self.state == CircuitBreaker.HALF_OPEN and not self.trial)
+      if self.state == CircuitBreaker.HALF_OPEN:
+        self.trial = True
+    self._changed(before)
+    return allowed
+
+  def success(self):
+    with self.lock:
+      before = self.state
+      if self.state != CircuitBreaker.CLOSED:
+        logging.info(f'Endpoint "{self.name}" is reachable again')
+      self.state = CircuitBreaker.CLOSED
+      self.count = 0
+      self.trial = False
+    self._changed(before)
+
+  def failure(self):
+    with self.lock:
+      before = self.state
+      self.count += 1
+      if self.state == CircuitBreaker.HALF_OPEN or (self.state == CircuitBreaker.CLOSED and self.count >= self.failures):
+        logging.warning(f'Endpoint "{self.name}" is down, failing calls to it for {self.cooldown}s')
+        self.state = CircuitBreaker.OPEN
+        self.opened = time.monotonic()
+        self.trial = False
+    self._changed(before)
+
+class HealthMonitor(Thread):
+  ''' Pings every remote endpoint of the active configuration
+
+  How often (and how long to wait for an answer) comes from "health"
+  under "options:", an interval of zero turns pinging off.
+  '''
+  def __init__(self, config):
+    Thread.__init__(self)
+    self.config = config
+    self.daemon = True
+    self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='health')
+
+  def _settings(self):
+    settings = self.config.getSettings().get('health', None) or {}
+    return float(settings.get('interval', 10)), float(settings.get('timeout', 2))
+
+  def check(self):
+    ''' Pings all remote endpoints at once and waits for the answers '''
+    interval, timeout = self._settings()
+    pm = self.config.getProgramManager()
+    endpoints = [endpoint for endpoint in list(pm.endpoints.values()) if hasattr(endpoint, 'ping')]
+    list(self.executor.map(lambda endpoint: endpoint.ping(timeout), endpoints))
+
+  def run(self):
+    while True:
+      interval, timeout = self._settings()
+      if interval <= 0:
+        time.sleep(10)
+        continue
+      try:
+        self.check()
+      except:
+        logging.exception('Failed to check endpoint health')
+      time.sleep(interval)
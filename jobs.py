@@ -0,0 +1,121 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+class Job:
+  STATE_QUEUED = 'queued'
+  STATE_RUNNING = 'running'
+  STATE_DONE = 'done'
+  STATE_FAILED = 'failed'
+
+  def __init__(self, operation, program):
+    self.id = uuid.uuid4().hex
+    self.operation = operation
+    self.program = program
+    self.state = Job.STATE_QUEUED
+    self.result = None
+    self.current = None
+    self.actions = []
+    self.slots = {}
+    self.created = time.time()
+    self.started = None
+    self.finished = None
+    self.lock = Lock()
+
+  def actionStarted(self, program, phase, index, action):
+    with self.lock:
+      if self.state == Job.STATE_QUEUED:
+        self.state = Job.STATE_RUNNING
+        self.started = time.time()
+      self.current = len(self.actions)
+      self.actions.append({
+        'program' : program.name,
+        'phase' : phase,
+        'index' : index,
+        'method' : action.method,
+        'endpoint' : action.endpoint.name,
+        'state' : Job.STATE_RUNNING,
+        'duration' : None,
+      })
+      self.slots[(program.name, phase, index)] = self.current
+
+  def actionFinished(self, program, phase, index, action, duration, error):
+    with self.lock:
+      entry = self.actions[self.slots.pop((program.name, phase, index))]
+      entry['state'] = Job.STATE_FAILED if error else Job.STATE_DONE
+      entry['duration'] = duration
+
+  def toDict(self):
+    with self.lock:
+      return {
+        'id' : self.id,
+        'operation' : self.operation,
+        'program' : self.program,
+        'state' : self.state,
+        'result' : self.result,
+        'current' : self.current,
+        'actions' : [dict(a) for a in self.actions],
+        'created' : self.created,
+        'started' : self.started,
+        'finished' : self.finished,
+      }
+
+class JobManager:
+  ''' Runs program start/stop requests in the background
+
+  Jobs are handed to the program manager as soon as they're submitted,
+  so they're carried out in order and a newer one cancels or replaces
+  older ones just like a waiting request would. The most recent jobs
+  are kept around so callers can poll them.
+  '''
+  def __init__(self, config, keep=50):
+    self.config = config
+    self.keep = keep
+    self.jobs = OrderedDict()
+    self.lock = Lock()
+
+  def _finished(self, job, future):
+    with job.lock:
+      try:
+        ret = future.result()
+        job.result = ret is not None and ret is not False
+        job.state = Job.STATE_DONE
+      except:
+        logging.exception(f'Job {job.id} ({job.operation} "{job.program}") failed')
+        job.result = False
+        job.state = Job.STATE_FAILED
+      job.finished = time.time()
+      if job.started is None:
+        # Skipped, or nothing to do
+        job.started = job.finished
+
+  def submit(self, operation, program):
+    job = Job(operation, program)
+    with self.lock:
+      self.jobs[job.id] = job
+      while len(self.jobs) > self.keep:
+        self.jobs.popitem(last=False)
+    future = self.config.getProgramManager().submit(operation, program, listener=job)
+    future.add_done_callback(lambda future: self._finished(job, future))
+    return job
+
+  def get(self, id):
+    with self.lock:
+      return self.jobs.get(id, None)
@@ -0,0 +1,34 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+import importlib
+import logging
+import time
+
+class LazyModule:
+  ''' Stand-in for a module which is imported the first time it's used '''
+  def __init__(self, name):
+    self._name = name
+    self._module = None
+
+  def __getattr__(self, attr):
+    if self._module is None:
+      started = time.perf_counter()
+      self._module = importlib.import_module(self._name)
+      logging.debug(f'Imported {self._name} in {(time.perf_counter() - started) * 1000:.1f}ms')
+    return getattr(self._module, attr)
+
+def lazy_import(name):
+  return LazyModule(name)
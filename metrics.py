@@ -0,0 +1,103 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+import bisect
+from threading import Lock
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format(names, values, extra=None):
+  pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+  if extra:
+    pairs.append(f'{extra[0]}="{extra[1]}"')
+  return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+  ''' Counts events, broken down by label values '''
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.values = {}
+    self.lock = Lock()
+
+  def inc(self, *labels, amount=1):
+    with self.lock:
+      self.values[labels] = self.values.get(labels, 0) + amount
+
+  def render(self):
+    lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+    with self.lock:
+      for labels, value in sorted(self.values.items()):
+        lines.append(f'{self.name}{_format(self.labels, labels)} {value}')
+    return lines
+
+class Histogram:
+  ''' Tracks how long things take, broken down by label values '''
+  BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+  def __init__(self, name, help, labels=(), buckets=BUCKETS):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.buckets = tuple(sorted(buckets))
+    self.values = {}
+    self.lock = Lock()
+
+  def observe(self, value, *labels):
+    with self.lock:
+      entry = self.values.get(labels, None)
+      if entry is None:
+        entry = self.values[labels] = {'counts' : [0] * (len(self.buckets) + 1), 'sum' : 0.0}
+      entry['counts'][bisect.bisect_left(self.buckets, value)] += 1
+      entry['sum'] += value
+
+  def render(self):
+    lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+    with self.lock:
+      for labels, entry in sorted(self.values.items()):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), entry['counts']):
+          total += count
+          lines.append(f'{self.name}_bucket{_format(self.labels, labels, ("le", bound))} {total}')
+        lines.append(f'{self.name}_sum{_format(self.labels, labels)} {entry["sum"]}')
+        lines.append(f'{self.name}_count{_format(self.labels, labels)} {total}')
+    return lines
+
+_metrics = []
+_lock = Lock()
+
+def _register(metric):
+  with _lock:
+    _metrics.append(metric)
+  return metric
+
+def counter(name, help, labels=()):
+  return _register(Counter(name, help, labels))
+
+def histogram(name, help, labels=(), buckets=Histogram.BUCKETS):
+  return _register(Histogram(name, help, labels, buckets))
+
+def render():
+  ''' Returns all metrics in the Prometheus text format '''
+  with _lock:
+    metrics = list(_metrics)
+  lines = []
+  for metric in metrics:
+    lines.extend(metric.render())
+  return '\n'.join(lines) + '\n'
@@ -0,0 +1,134 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+import time
+import logging
+import fnmatch
+from threading import Lock
+
+from lazyimport import lazy_import
+psutil = lazy_import('psutil')
+
+class ProcessTable:
+  ''' Index of running processes by name
+
+  The table is built from a single scan of all processes and reused for
+  up to "maxage" seconds, so several lookups in a row only scan once.
+  '''
+  def __init__(self, maxage=1.0):
+    self.maxage = maxage
+    self.names = {}
+    self.updated = 0
+    self.lock = Lock()
+
+  def refresh(self):
+    names = {}
+    for proc in psutil.process_iter(['name']):
+      name = proc.info['name']
+      if name:
+        names.setdefault(name, []).append(proc)
+    with self.lock:
+      self.names = names
+      self.updated = time.monotonic()
+
+  def find(self, names, refresh=False):
+    ''' Returns all processes matching any of the names
+
+    Names may contain shell-style wildcards (*, ? and [seq]).
+    '''
+    if refresh or time.monotonic() - self.updated > self.maxage:
+      self.refresh()
+
+    found = []
+    with self.lock:
+      for name in names:
+        if any(c in name for c in '*?['):
+          for candidate in self.names:
+            if fnmatch.fnmatch(candidate, name):
+              found.extend(self.names[candidate])
+        else:
+          found.extend(self.names.get(name, []))
+    # Multiple patterns may match the same process
+    return list({proc.pid : proc for proc in found}.values())
+
+  def forget(self, procs):
+    ''' Drops processes known to be gone from the table '''
+    with self.lock:
+      for proc in procs:
+        entries = self.names.get(proc.info['name'], [])
+        if proc in entries:
+          entries.remove(proc)
+
+  def terminate(self, procs, timeout=3, force=True):
+    ''' Asks all processes to terminate and waits for them to exit
+
+    Processes still around after timeout seconds are killed if force is
+    set. Returns the processes which exited.
+    '''
+    signalled = []
+    for proc in procs:
+      try:
+        logging.debug(f'Terminating {proc.info["name"]} ({proc.pid})')
+        proc.terminate()
+        signalled.append(proc)
+      except psutil.NoSuchProcess:
+        logging.debug(f'PID {proc.pid} already gone')
+      except psutil.AccessDenied:
+        logging.warning(f'Not allowed to terminate {proc.info["name"]} ({proc.pid})')
+
+    gone, alive = psutil.wait_procs(signalled, timeout=timeout)
+    if alive and force:
+      for proc in alive:
+        try:
+          logging.info(f'{proc.info["name"]} ({proc.pid}) did not exit in time, killing it')
+          proc.kill()
+        except psutil.NoSuchProcess:
+          pass
+        except psutil.AccessDenied:
+          logging.warning(f'Not allowed to kill {proc.info["name"]} ({proc.pid})')
+      killed, alive = psutil.wait_procs(alive, timeout=timeout)
+      gone += killed
+    if alive:
+      logging.warning(f'Processes {[proc.pid for proc in alive]} are still running')
+
+    self.forget(gone)
+    return gone
+
+_table = None
+_lock = Lock()
+
+def table():
+  ''' Returns the shared process table '''
+  global _table
+  with _lock:
+    if _table is None:
+      _table = ProcessTable()
+    return _table
+
+def memory(pids):
+  ''' Adds up the resident memory (in bytes) of processes and their children '''
+  total = 0
+  for pid in pids:
+    try:
+      procs = psutil.Process(pid)
+      procs = [procs] + procs.children(recursive=True)
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+      continue
+    for proc in procs:
+      try:
+        total += proc.memory_info().rss
+      except (psutil.NoSuchProcess, psutil.AccessDenied):
+        pass
+  return total
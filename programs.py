@@ -14,25 +14,120 @@
 # along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
 #
 import logging
+import threading
+import time
+from operator import methodcaller
+from concurrent.futures import ThreadPoolExecutor
 
-from endpoints import LocalEndpoint, RemoteEndpoint
+from endpoints import LocalEndpoint, RemoteEndpoint, FanoutEndpoint, may_wait
+from actiongraph import ActionGraph
+import adaptive
+import cancellation
+import metrics
+import processes
+import tracing
+from cancellation import CancelToken, Cancelled
+from events import EventBus, Listeners, ProgressEvents
+
+ACTIONS = metrics.counter('windowopener_actions_total', 'Actions performed, by outcome', ['program', 'operation', 'method', 'endpoint', 'outcome'])
+ACTION_SECONDS = metrics.histogram('windowopener_action_duration_seconds', 'Time taken by actions', ['program', 'operation', 'method', 'endpoint'])
+SWITCHES = metrics.counter('windowopener_program_switches_total', 'Programs started or stopped, by outcome', ['program', 'operation', 'outcome'])
+SWITCH_SECONDS = metrics.histogram('windowopener_program_switch_duration_seconds', 'Time taken to start or stop a program', ['program', 'operation'])
 
 class ProgramManager:
-  def __init__(self):
+  def __init__(self, workers=4):
     self.PROGRAMS = {}
     self.endpoints = {'local' : LocalEndpoint('local')}
-    self.activeProgram = None
+    # Active programs by name, in the order they were started. Replaced
+    # rather than changed, so readers on other threads can use it freely.
+    self.active = {}
+    self.workers = workers
+    self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='action')
+    self.commands = ThreadPoolExecutor(max_workers=1, thread_name_prefix='program')
+    # Calls to the members of endpoint groups, never waiting on each other
+    self.fanout = ThreadPoolExecutor(max_workers=workers * 4, thread_name_prefix='fanout')
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    # Keeps switches queued in the order they were requested
+    self.queue = threading.Lock()
+    self.requests = 0
+    self.pending = []
+    self.starting = None
+    self.recent = []
+    self.prewarmPolicy = {}
+    self.remeasure = None
+    self.events = EventBus()
+    # Goes up whenever something GET /program reports on changes
+    self.version = 0
+    self.changes = threading.Condition()
+
+  def _changed(self):
+    with self.changes:
+      self.version += 1
+      self.changes.notify_all()
+
+  def getVersion(self):
+    return self.version
+
+  def waitForChange(self, version, timeout):
+    ''' Waits up to timeout seconds for the version to differ from version, returns the current one '''
+    with self.changes:
+      self.changes.wait_for(lambda: self.version != version, timeout)
+      return self.version
+
+  def _command(self, func, args, kwargs):
+    self.local.command = True
+    return func(*args, **kwargs)
+
+  def run(self, func, *args, **kwargs):
+    ''' Runs func on the command thread once all earlier commands are done
+
+    Everything which changes programs or the active program goes through
+    here, so such changes happen one at a time and in the order requested
+    while reads carry on without waiting. Calls made from the command
+    thread itself run right away.
+    '''
+    if getattr(self.local, 'command', False):
+      return func(*args, **kwargs)
+    return self.commands.submit(self._command, func, args, kwargs).result()
 
-  def createEndpoint(self, name, url, token):
+  def createEndpoint(self, name, url, token, **settings):
     if name not in self.endpoints:
-      self.endpoints[name] = RemoteEndpoint(name, url, token)
+      settings.setdefault('pool_size', self.workers)
+      self.endpoints[name] = RemoteEndpoint(name, url, token, **settings)
+      self.endpoints[name].breaker.listener = self._changed
+      self._changed()
     return self.endpoints[name]
 
+  def createGroup(self, name, members, policy=FanoutEndpoint.ALL):
+    ''' Creates an endpoint carrying out actions on all the listed endpoints at once '''
+    if name not in self.endpoints:
+      self.endpoints[name] = FanoutEndpoint(name, [self.endpoints[member] for member in members], policy, self.fanout)
+    return self.endpoints[name]
+
+  def removeEndpoint(self, name):
+    if name == 'local':
+      return
+    endpoint = self.endpoints.pop(name, None)
+    # Groups can't outlive their members
+    for group in [key for key, value in list(self.endpoints.items()) if isinstance(value, FanoutEndpoint) and endpoint in value.endpoints]:
+      self.endpoints.pop(group, None)
+    if endpoint:
+      self._changed()
+
   def createProgram(self, name):
     if name not in self.PROGRAMS:
-      self.PROGRAMS[name] = Program(name)
+      self.PROGRAMS[name] = Program(name, self.executor)
+      self._changed()
     return self.PROGRAMS[name]
 
+  def removeProgram(self, name):
+    prg = self.PROGRAMS.pop(name, None)
+    if prg and prg.isWarm():
+      prg.coolDown()
+    if prg:
+      self._changed()
+
   def getEndpoint(self, name):
     return self.endpoints.get(name, None)
 
@@ -40,40 +135,261 @@ class ProgramManager:
     return list(self.PROGRAMS.keys())
 
   def getActiveProgram(self):
-    return self.activeProgram.name if self.activeProgram else None
+    ''' Returns the most recently started of the active programs '''
+    names = list(self.active)
+    return names[-1] if names else None
+
+  def getActivePrograms(self):
+    return list(self.active)
+
+  def getWarmPrograms(self):
+    return [name for name, prg in list(self.PROGRAMS.items()) if prg.isWarm()]
+
+  def getEndpointHealth(self):
+    ''' Reports how the remote endpoints are doing '''
+    return {name : endpoint.health() for name, endpoint in list(self.endpoints.items()) if hasattr(endpoint, 'health')}
+
+  def setPrewarmPolicy(self, policy):
+    ''' Chooses which programs are kept warm
+
+    The policy lists programs to always keep warm ("programs"), how
+    many of the most recently started ones to keep warm as well
+    ("recent") and how much memory, in MB, the warm processes may use
+    ("memory", zero for no limit). Only programs with a prewarm section
+    are ever kept warm. Programs are measured again "settle" seconds
+    after being launched, once they had time to load.
+    '''
+    self.prewarmPolicy = policy or {}
+    self._schedulePrewarm()
+
+  def _schedulePrewarm(self):
+    if self.prewarmPolicy or self.getWarmPrograms():
+      self.commands.submit(self._command, self._prewarm, (), {})
+
+  def _prewarm(self):
+    ''' Warms up the programs the policy asks for and cools down all others '''
+    policy = self.prewarmPolicy
+    active = self.getActivePrograms()
+    warm = self.getWarmPrograms()
+    wanted = []
+    recent = [name for name in self.recent if name not in active][:int(policy.get('recent', 0))]
+    for name in list(policy.get('programs', None) or []) + recent:
+      prg = self.PROGRAMS.get(name, None)
+      if prg and prg.prewarmActions and name not in active and prg not in wanted:
+        wanted.append(prg)
+
+    # Programs come in order of preference, so the limit leaves out the least wanted ones
+    limit = float(policy.get('memory', 0)) * 1024 * 1024
+    used = 0
+    keep = []
+    launched = False
+    with cancellation.activate(None):
+      for prg in wanted:
+        if prg.isWarm():
+          prg.warmSize = prg.warmMemory()
+        if limit and used + prg.warmSize > limit:
+          logging.info(f'Not keeping "{prg.name}" warm, it would exceed the memory limit')
+          continue
+        if not prg.isWarm():
+          # Judged by its size last time it was warm, which is unknown the first time
+          logging.info(f'Warming up "{prg.name}"')
+          prg.warmUp()
+          launched = True
+        used += prg.warmSize
+        keep.append(prg)
+
+      for prg in list(self.PROGRAMS.values()):
+        if prg not in keep and prg.isWarm():
+          logging.info(f'Cooling down "{prg.name}"')
+          prg.coolDown()
+    if self.getWarmPrograms() != warm:
+      self._changed()
+    if launched and limit:
+      # Freshly launched processes hardly use any memory yet, check again once they're loaded
+      if self.remeasure:
+        self.remeasure.cancel()
+      self.remeasure = threading.Timer(float(policy.get('settle', 10)), self._schedulePrewarm)
+      self.remeasure.daemon = True
+      self.remeasure.start()
+
+  def _conflicts(self, name, other):
+    ''' True if programs name and other can't be active at the same time '''
+    prg = self.PROGRAMS.get(name, None)
+    rival = self.PROGRAMS.get(other, None)
+    return not prg or not rival or prg.conflictsWith(rival)
+
+  def _replaces(self, later, earlier):
+    ''' True if the later request makes the earlier one pointless
+
+    Requests are (operation, name) pairs, with a stop of None meaning
+    stopping all programs. A stop is only ever replaced by a later stop
+    covering it, since a start which would stop the same program might
+    get skipped or cancelled itself.
+    '''
+    operation, name = later
+    if operation == 'stop':
+      return name is None or earlier[1] == name
+    if earlier[0] == 'stop':
+      return False
+    return self._conflicts(name, earlier[1])
+
+  def _request(self, operation, name):
+    ''' Registers a request to start or stop name (stopping None meaning all)
 
-  def start(self, name):
+    A start in progress which the request makes pointless is cancelled,
+    and so are switches still waiting their turn (they will be skipped).
+    '''
+    with self.lock:
+      self.requests += 1
+      self.pending.append((self.requests, operation, name))
+      if self.starting and self.starting[0] != name and self._replaces((operation, name), ('start', self.starting[0])):
+        logging.info(f'Cancelling start of "{self.starting[0]}", a request to {operation} "{name}" replaced it')
+        self.starting[1].cancel()
+      elif self.starting and operation == 'stop' and self.starting[0] == name:
+        logging.info(f'Cancelling start of "{name}", it was asked to stop')
+        self.starting[1].cancel()
+      return self.requests
+
+  def _superseded(self, ticket, operation, name):
+    ''' Must hold the lock, also forgets about the request '''
+    later = [(op, other) for number, op, other in self.pending if number > ticket]
+    self.pending = [entry for entry in self.pending if entry[0] != ticket]
+    if any(self._replaces(request, (operation, name)) for request in later):
+      logging.info(f'Skipping request to {operation} "{name}", a newer request replaced it')
+      return True
+    return False
+
+  def _listener(self, listener):
+    ''' Adds publishing progress events to listener, if anyone listens to them '''
+    if not self.events.active() or isinstance(listener, Listeners):
+      return listener
+    return Listeners([listener, ProgressEvents(self.events)])
+
+  def _publishSwitch(self, operation, name, state, duration=None):
+    self.events.publish('switch', {'operation' : operation, 'program' : name, 'state' : state, 'duration' : duration})
+
+  def _switchStart(self, ticket, name, listener):
+    token = CancelToken()
+    with self.lock:
+      if self._superseded(ticket, 'start', name):
+        self._publishSwitch('start', name, 'skipped')
+        return None
+      self.starting = (name, token)
+    try:
+      with cancellation.activate(token):
+        return self._start(name, listener)
+    finally:
+      with self.lock:
+        self.starting = None
+      self._schedulePrewarm()
+
+  def _switchStop(self, ticket, name, listener):
+    with self.lock:
+      if self._superseded(ticket, 'stop', name):
+        self._publishSwitch('stop', name, 'skipped')
+        return False
+    try:
+      return self._stop(name, listener)
+    finally:
+      self._schedulePrewarm()
+
+  def submit(self, operation, name=None, listener=None):
+    ''' Requests a start or stop of name and returns a future for its result
+
+    The request is registered right away, so it cancels or replaces
+    earlier ones while they're still waiting or running, even though the
+    caller doesn't wait for it.
+    '''
+    func = self._switchStart if operation == 'start' else self._switchStop
+    name = name or None
+    with self.queue:
+      return self.commands.submit(self._command, func, (self._request(operation, name), name, listener), {})
+
+  def start(self, name, listener=None):
+    return self.submit('start', name, listener).result()
+
+  def stop(self, name=None, listener=None):
+    ''' Stops the named program, or all active programs without a name '''
+    return self.submit('stop', name, listener).result()
+
+  def _start(self, name, listener):
     if name not in self.PROGRAMS:
       logging.error(f'Program "{name}" does not exist')
       return None
-    if self.activeProgram and self.activeProgram.name == name:
+    if name in self.active:
       logging.warning(f'Program "{name}" is already active')
-      return self.activeProgram
-    self.stop()
+      return self.active[name]
+    listener = self._listener(listener)
     p = self.PROGRAMS[name]
-    ret = p.start()
-    if ret:
-      self.activeProgram = p
-      return p
-    return None
+    with tracing.trace(f'start {name}', program=name) as span:
+      with cancellation.activate(None):
+        # Only what competes for the same resources has to go
+        for other in reversed(list(self.active.values())):
+          if p.conflictsWith(other):
+            self._stopProgram(other, listener)
+      self._publishSwitch('start', name, 'running')
+      started = time.monotonic()
+      try:
+        ret = p.start(listener)
+      except Exception:
+        self._publishSwitch('start', name, 'failed', time.monotonic() - started)
+        raise
+      elapsed = time.monotonic() - started
+      SWITCH_SECONDS.observe(elapsed, name, 'start')
+      SWITCHES.inc(name, 'start', 'success' if ret else 'cancelled')
+      if ret:
+        self.active = {**self.active, name : p}
+        if name in self.recent:
+          self.recent.remove(name)
+        self.recent.insert(0, name)
+        self._publishSwitch('start', name, 'done', elapsed)
+        self.events.publish('active', {'active' : name, 'running' : self.getActivePrograms()})
+        self._changed()
+        return p
+      span['status'] = 'cancelled'
+      self._publishSwitch('start', name, 'cancelled', elapsed)
+      return None
 
-  def stop(self, name=None):
-    if not self.activeProgram:
-      return False
-    if name and name != self.activeProgram.name:
+  def _stop(self, name, listener):
+    ''' Stops the named program, or all active programs (most recent first) if name is None '''
+    if name is None:
+      programs = list(reversed(list(self.active.values())))
+    elif name in self.active:
+      programs = [self.active[name]]
+    else:
       return False
+    for p in programs:
+      self._stopProgram(p, listener)
+    return len(programs) > 0
 
-    self.activeProgram.stop()
-    self.activeProgram = None
-    return True
+  def _stopProgram(self, p, listener):
+    name = p.name
+    self._publishSwitch('stop', name, 'running')
+    started = time.monotonic()
+    with tracing.trace(f'stop {name}', program=name):
+      p.stop(self._listener(listener))
+    elapsed = time.monotonic() - started
+    SWITCH_SECONDS.observe(elapsed, name, 'stop')
+    SWITCHES.inc(name, 'stop', 'success')
+    self.active = {other : prg for other, prg in self.active.items() if other != name}
+    self._publishSwitch('stop', name, 'done', elapsed)
+    self.events.publish('active', {'active' : self.getActiveProgram(), 'running' : self.getActivePrograms()})
+    self._changed()
 
 class Program:
-  def __init__(self, name):
+  def __init__(self, name, executor=None):
     self.START_ACTIONS = []
     self.PRE_STOP_ACTIONS = []
     self.POST_STOP_ACTIONS = []
     self.safe = True
     self.name = name
+    self.executor = executor
+    self.prewarmActions = []
+    self.skipActions = []
+    self.window = 'minimized'
+    self.warmSize = 0
+    # What the program needs to itself, None for everything
+    self.resources = None
 
   def addStartAction(self, endpoint, method, *args):
     ''' Command(s) to run when starting
@@ -83,6 +399,7 @@ class Program:
       logging.error(f'No such method "{method}" for start actions')
       return False
     action = Action(endpoint, method, args)
+    action.program = self.name
     self.START_ACTIONS.append(action)
     return action
 
@@ -91,6 +408,7 @@ class Program:
       logging.error(f'No such method "{method}" for stop actions')
       return False
     action = Action(endpoint, method, arguments)
+    action.program = self.name
     self.POST_STOP_ACTIONS.append(action)
     return action
 
@@ -98,20 +416,206 @@ class Program:
     if method not in Action.METHOD_STOP:
       logging.error(f'No such method "{method}" for pre-stop actions')
       return False
-    self.PRE_STOP_ACTIONS.append(Action(endpoint, method, arguments))
+    action = Action(endpoint, method, arguments)
+    action.program = self.name
+    self.PRE_STOP_ACTIONS.append(action)
+    return action
+
+  def setResources(self, resources):
+    ''' Declares what the program needs to itself, like "display@remote"
+
+    A resource without an endpoint is taken to be on the local one.
+    Programs which don't declare resources need everything.
+    '''
+    if resources is None:
+      self.resources = None
+      return
+    self.resources = set(resource.lower() if '@' in resource else f'{resource.lower()}@local' for resource in resources)
+
+  def conflictsWith(self, other):
+    ''' True if this program and other can't be active at the same time '''
+    if self is other or self.resources is None or other.resources is None:
+      return True
+    return len(self.resources & other.resources) > 0
+
+  def _resolve(self, refs):
+    ''' Finds start actions by name or index '''
+    found = []
+    for ref in refs:
+      if isinstance(ref, int) and 0 <= ref < len(self.START_ACTIONS):
+        found.append(self.START_ACTIONS[ref])
+        continue
+      named = [action for action in self.START_ACTIONS if action.id is not None and action.id == ref]
+      if not named:
+        logging.error(f'Program "{self.name}" has no start action "{ref}"')
+        return None
+      found.extend(named)
+    return found
+
+  def setPrewarm(self, actions=None, window='minimized', skip=None):
+    ''' Chooses the start actions which may be launched ahead of time
+
+    Without a list, all execute actions are chosen. The actions in skip
+    are left out when the program starts from prewarmed processes.
+    '''
+    if actions is None:
+      chosen = [action for action in self.START_ACTIONS if action.method == Action.ACTION_EXECUTE]
+    else:
+      chosen = self._resolve(actions)
+    skipped = self._resolve(skip or [])
+    if chosen is None or skipped is None:
+      return False
+    if any(action.method != Action.ACTION_EXECUTE for action in chosen):
+      logging.error(f'Program "{self.name}" can only prewarm execute actions')
+      return False
+    if window not in LocalEndpoint.SHOW:
+      logging.error(f'Program "{self.name}" can\'t prewarm with window "{window}"')
+      return False
+    self.prewarmActions = chosen
+    self.skipActions = skipped
+    self.window = window
+    return True
+
+  def isWarm(self):
+    return any(action.warm != -1 for action in self.prewarmActions)
+
+  def warmUp(self):
+    for action in self.prewarmActions:
+      action.prewarm(self.window)
+
+  def coolDown(self):
+    for action in self.prewarmActions:
+      action.cool()
+
+  def warmMemory(self):
+    ''' Memory used by the prewarmed processes, only local ones are known '''
+    return processes.memory([action.warm for action in self.prewarmActions if action.warm != -1 and isinstance(action.endpoint, LocalEndpoint)])
+
+  def validate(self):
+    ''' Raises GraphError if any action list has broken dependencies, then
+    pairs adaptive delays with the step waiting for them
+    '''
+    for phase, actions in [('start', self.START_ACTIONS), ('pre-stop', self.PRE_STOP_ACTIONS), ('stop', self.POST_STOP_ACTIONS)]:
+      ActionGraph(actions)
+      for index, action in enumerate(actions):
+        if not action.adaptive():
+          continue
+        action.key = f'{self.name}/{phase}/{action.id or index}'
+        follower = actions[index + 1] if index + 1 < len(actions) else None
+        if follower and follower.after is None and follower.method in Action.PROBES:
+          follower.probe = action
+
+  def _batch(self, actions):
+    ''' Merges consecutive actions for the same remote endpoint into batches
+
+    Only actions which simply follow the previous one are merged, and
+    never delays or waits, which have to end the moment a start is
+    cancelled.
+    '''
+    units = []
+    i = 0
+    while i < len(actions):
+      endpoint = actions[i].endpoint
+      if not getattr(endpoint, 'batching', False) or not actions[i].batchable():
+        units.append(actions[i])
+        i += 1
+        continue
+
+      end = i + 1
+      while end < len(actions) and actions[end].endpoint is endpoint and actions[end].after is None and actions[end].id is None and actions[end].batchable():
+        end += 1
+
+      if end - i > 1:
+        units.append(ActionBatch(endpoint, actions[i:end]))
+      else:
+        units.append(actions[i])
+      i = end
+    return units
+
+  def _run(self, phase, actions, func, listener, batch=False):
+    ''' Runs func on every action, reporting progress to listener (if any)
+
+    The listener is told about each action through actionStarted() and
+    actionFinished(), both of which receive the program, phase and the
+    index of the action within that phase.
+    '''
+    units = self._batch(actions) if batch else actions
+    if not units:
+      return
+    if not listener:
+      with tracing.span(phase, program=self.name):
+        ActionGraph(units).run(func, self.executor)
+      return
+
+    index = {id(action) : i for i, action in enumerate(actions)}
+    def step(unit):
+      members = unit.actions if isinstance(unit, ActionBatch) else [unit]
+      for action in members:
+        listener.actionStarted(self, phase, index[id(action)], action)
+      started = time.monotonic()
+      try:
+        func(unit)
+      except Exception as e:
+        for action in members:
+          listener.actionFinished(self, phase, index[id(action)], action, time.monotonic() - started, e)
+        raise
+      elapsed = time.monotonic() - started
+      durations = unit.durations if isinstance(unit, ActionBatch) else [elapsed]
+      for action, duration in zip(members, durations):
+        listener.actionFinished(self, phase, index[id(action)], action, elapsed if duration is None else duration, None)
+    with tracing.span(phase, program=self.name):
+      ActionGraph(units).run(step, self.executor)
 
-  def start(self):
-    for action in self.START_ACTIONS:
-      action.execute()
+  def start(self, listener=None):
+    warm = self.prewarmActions and all(action.warm != -1 for action in self.prewarmActions)
+    for action in self.skipActions:
+      action.skip = bool(warm)
+    try:
+      self._run('start', self.START_ACTIONS, methodcaller('execute'), listener, batch=True)
+    except Cancelled:
+      logging.info(f'Start of "{self.name}" was cancelled, rolling back')
+      with cancellation.activate(None):
+        self._run('rollback', self.START_ACTIONS, methodcaller('finish'), listener)
+      return False
+    finally:
+      for action in self.skipActions:
+        action.skip = False
     return True
 
-  def stop(self):
-    for action in self.PRE_STOP_ACTIONS:
-      action.execute()
-    for action in self.START_ACTIONS:
-      action.finish()
-    for action in self.POST_STOP_ACTIONS:
-      action.execute()
+  def stop(self, listener=None):
+    self._run('prestop', self.PRE_STOP_ACTIONS, methodcaller('execute'), listener, batch=True)
+    self._run('finish', self.START_ACTIONS, methodcaller('finish'), listener)
+    self._run('stop', self.POST_STOP_ACTIONS, methodcaller('execute'), listener, batch=True)
+
+class ActionBatch:
+  ''' A run of actions carried out by a remote endpoint in one request '''
+  def __init__(self, endpoint, actions):
+    self.endpoint = endpoint
+    self.actions = actions
+    self.method = 'batch'
+    self.id = actions[0].id
+    self.after = actions[0].after
+    self.durations = [None] * len(actions)
+
+  def execute(self):
+    results = None
+    if Action.reachable(self.endpoint):
+      results = self.endpoint.batch([action.toRequest() for action in self.actions])
+    if results is None:
+      # The endpoint can't do batches (or is down and each action decides
+      # how to handle that), do it one by one instead
+      for i, action in enumerate(self.actions):
+        started = time.monotonic()
+        action.execute()
+        self.durations[i] = time.monotonic() - started
+      return
+
+    for i, action in enumerate(self.actions):
+      entry = results[i] if i < len(results) else {}
+      self.durations[i] = entry.get('duration', None)
+      ret = entry.get('result', False)
+      action.record('execute', self.durations[i], 'success' if Action.succeeded(ret) else 'failure')
+      action.applyResult(ret)
 
 class Action:
   ACTION_EXECUTE = 'execute'
@@ -122,9 +626,47 @@ class Action:
   ACTION_SENDKEYS = 'sendkeys'
   ACTION_FOCUS = 'focus'
   ACTION_MOUSE_MOVE = 'mouse move'
+  ACTION_REVEAL = 'reveal'
+  ACTION_WAIT_PROCESS = 'wait process'
+  ACTION_WAIT_WINDOW = 'wait window'
+  ACTION_WAIT_PORT = 'wait port'
+  ACTION_WAIT_FILE = 'wait file'
+  ACTION_INPUT_SEQUENCE = 'input sequence'
+
+  METHOD_WAIT = [ACTION_WAIT_PROCESS, ACTION_WAIT_WINDOW, ACTION_WAIT_PORT, ACTION_WAIT_FILE]
+  METHOD_START = [ACTION_EXECUTE, ACTION_DELAY, ACTION_SENDKEYS, ACTION_FOCUS, ACTION_MOUSE_MOVE, ACTION_INPUT_SEQUENCE] + METHOD_WAIT
+  METHOD_STOP = [ACTION_DELAY, ACTION_CLOSE_WINDOW, ACTION_KILL_PID, ACTION_KILL_APP, ACTION_SENDKEYS, ACTION_FOCUS, ACTION_MOUSE_MOVE, ACTION_INPUT_SEQUENCE] + METHOD_WAIT
+  # Only used between instances, not available in programs
+  METHOD_INTERNAL = [ACTION_REVEAL]
 
-  METHOD_START = [ACTION_EXECUTE, ACTION_DELAY, ACTION_SENDKEYS, ACTION_FOCUS, ACTION_MOUSE_MOVE]
-  METHOD_STOP = [ACTION_DELAY, ACTION_CLOSE_WINDOW, ACTION_KILL_PID, ACTION_KILL_APP, ACTION_SENDKEYS, ACTION_FOCUS, ACTION_MOUSE_MOVE]
+  # What to do when the endpoint is known to be down
+  IFDOWN_FAIL = 'fail'
+  IFDOWN_SKIP = 'skip'
+  IFDOWN = [IFDOWN_FAIL, IFDOWN_SKIP]
+
+  # Steps which can simply be tried again when they fail, so an adaptive
+  # delay before them can be cut short and make up for it by retrying
+  PROBES = [ACTION_FOCUS, ACTION_CLOSE_WINDOW, ACTION_KILL_APP]
+  PROBE_INTERVAL = 0.25
+  # When the step after an adaptive delay works right away, the delay
+  # is counted as needing this much of what it waited
+  SHRINK = 0.5
+
+  FUNCTIONS = {
+    ACTION_DELAY : 'delay',
+    ACTION_KILL_APP : 'kill_app',
+    ACTION_KILL_PID : 'kill_pid',
+    ACTION_CLOSE_WINDOW : 'close_window',
+    ACTION_SENDKEYS : 'sendkeys',
+    ACTION_FOCUS : 'focus',
+    ACTION_MOUSE_MOVE : 'mouse_move',
+    ACTION_REVEAL : 'reveal',
+    ACTION_WAIT_PROCESS : 'wait_process',
+    ACTION_WAIT_WINDOW : 'wait_window',
+    ACTION_WAIT_PORT : 'wait_port',
+    ACTION_WAIT_FILE : 'wait_file',
+    ACTION_INPUT_SEQUENCE : 'input_sequence',
+  }
 
   def __init__(self, endpoint, method, *arguments):
     self.endpoint = endpoint
@@ -132,38 +674,193 @@ class Action:
     self.arguments = arguments
     self.options = {}
     self.pid = -1
+    self.id = None
+    self.after = None
+    self.program = None
+    self.warm = -1
+    self.skip = False
+    self.ifdown = Action.IFDOWN_FAIL
+    self.key = None
+    self.probe = None
+    self.started = None
+    self.waited = 0
+    self.learned = False
 
   def setOptions(self, options):
     self.options = options if options else {}
 
+  def setIfDown(self, policy):
+    self.ifdown = policy
+
+  def setDependencies(self, name, after):
+    ''' Names this step and lists the steps it must wait for
+    An "after" of None means it simply follows the previous step
+    '''
+    self.id = name
+    self.after = after
+
   def finish(self):
     if self.pid == -1:
       logging.debug(f'{self.arguments} has no pid to kill')
       return
-    self.endpoint.kill_pid({}, self.pid)
+    self._measure('finish', lambda: self.endpoint.kill_pid({}, self.pid))
     self.pid = -1
 
-  def execute(self):
-    ret = None
-    if self.method == Action.ACTION_EXECUTE:
-      ret = self.endpoint.execute(self.options, *self.arguments)
-      if ret == -1:
-        logging.error(f'Unable to execute command ({self.arguments})')
-        ret = None
-      else:
-        self.pid = ret
-    elif self.method == Action.ACTION_DELAY:
-      self.endpoint.delay(self.options, *self.arguments[0])
-    elif self.method == Action.ACTION_KILL_APP:
-      self.endpoint.kill_app(self.options, *self.arguments[0])
-    elif self.method == Action.ACTION_KILL_PID:
-      self.endpoint.kill_pid(self.options, *self.arguments[0])
-    elif self.method == Action.ACTION_CLOSE_WINDOW:
-      self.endpoint.close_window(self.options, *self.arguments[0])
-    elif self.method == Action.ACTION_SENDKEYS:
-      self.endpoint.sendkeys(self.options, *self.arguments[0])
-    elif self.method == Action.ACTION_FOCUS:
-      self.endpoint.focus(self.options, *self.arguments[0])
-    elif self.method == Action.ACTION_MOUSE_MOVE:
-      self.endpoint.mouse_move(self.options, *self.arguments[0], *self.arguments[1])
+  def prewarm(self, window):
+    ''' Launches this action ahead of time, for execute() to adopt later '''
+    if self.method != Action.ACTION_EXECUTE or self.warm != -1:
+      return
+    options = dict(self.options)
+    options['window'] = window
+    ret = self._measure('prewarm', lambda: Action.dispatch(self.endpoint, self.method, options, self.arguments[0]))
+    if Action.succeeded(ret):
+      logging.debug(f'Prewarmed {self.arguments[0]}, PID = {ret}')
+      self.warm = ret
+
+  def cool(self):
+    ''' Terminates whatever prewarm() launched '''
+    if self.warm == -1:
+      return
+    self._measure('cool', lambda: self.endpoint.kill_pid({}, self.warm))
+    self.warm = -1
+
+  def _adopt(self):
+    pid = self.warm
+    self.warm = -1
+    if self._measure('adopt', lambda: self.endpoint.reveal(self.options, pid)):
+      logging.debug(f'Adopted prewarmed {self.arguments[0]}, PID = {pid}')
+      self.pid = pid
+      return pid
+    # Gone, or the endpoint couldn't show it, so start over
+    logging.info(f'Prewarmed {self.arguments[0]} could not be adopted, starting it again')
+    self.endpoint.kill_pid({}, pid)
+    return None
+
+  @staticmethod
+  def dispatch(endpoint, method, options, arguments):
+    ''' Calls the endpoint function implementing method '''
+    if method == Action.ACTION_EXECUTE:
+      return endpoint.execute(options, arguments)
+    return getattr(endpoint, Action.FUNCTIONS[method])(options, *arguments)
+
+  def batchable(self):
+    ''' Prewarmed, skipped, probing and waiting actions need handling a batch can't give them '''
+    request = self.toRequest()
+    return self.warm == -1 and not self.skip and self.probe is None and not may_wait(request['method'], request['options'], request['arguments'])
+
+  def adaptive(self):
+    return self.method == Action.ACTION_DELAY and bool(self.options.get('adaptive', False))
+
+  def _delay(self):
+    ''' Waits as long as this delay needed before (at most as configured) and learns from it '''
+    configured = float(self.arguments[0][0])
+    learned = adaptive.stats().learned(self.key, float(self.options.get('percentile', 90)), int(self.options.get('samples', 5)))
+    self.waited = configured if learned is None else min(configured, learned)
+    self.learned = False
+    self.started = time.monotonic()
+    ret = self._measure('execute', lambda: Action.dispatch(self.endpoint, self.method, self.options, [self.waited]))
+    if self.options.get('orhasaudio', False):
+      elapsed = time.monotonic() - self.started
+      # Audio showing up ends the delay early, which tells exactly what it
+      # needed. Without audio, count all of it to be on the safe side.
+      adaptive.stats().add(self.key, elapsed if elapsed < self.waited - Action.PROBE_INTERVAL else configured)
+      self.learned = True
+    return ret
+
+  def _retry(self, ret):
+    ''' Tries this step again until it works or the adaptive delay before it
+    has used up all of its configured time, and learns how long it needed
+    '''
+    delay = self.probe
+    started = delay.started
+    delay.started = None
+    budget = float(delay.arguments[0][0])
+    attempts = 1
+    while not Action.succeeded(ret) and time.monotonic() - started < budget:
+      cancellation.current().sleep(Action.PROBE_INTERVAL)
+      attempted = time.monotonic()
+      attempts += 1
+      ret = self._measure('probe', lambda: Action.dispatch(self.endpoint, self.method, self.options, self.arguments[0]))
+    if delay.learned:
+      return ret
+    if not Action.succeeded(ret):
+      needed = budget
+    elif attempts == 1:
+      needed = delay.waited * Action.SHRINK
+    else:
+      needed = attempted - started
+    adaptive.stats().add(delay.key, min(needed, budget))
     return ret
+
+  def toRequest(self):
+    ''' Describes this action the way the lowlevel API expects it '''
+    return {'method' : self.method, 'arguments' : list(self.arguments[0]), 'options' : self.options}
+
+  @staticmethod
+  def succeeded(ret):
+    ''' Tells if the value returned by an endpoint function means success '''
+    return not (ret is None or ret is False or ret == -1)
+
+  def record(self, operation, duration, outcome):
+    ''' Adds one run of this action to the metrics, duration may be None if unknown '''
+    labels = (self.program or '', operation, self.method, getattr(self.endpoint, 'name', ''))
+    ACTIONS.inc(*labels, outcome)
+    if duration is not None:
+      ACTION_SECONDS.observe(duration, *labels)
+
+  def _measure(self, operation, func):
+    started = time.monotonic()
+    outcome = 'failure'
+    try:
+      with tracing.span(f'{operation} {self.method}', endpoint=getattr(self.endpoint, 'name', ''), arguments=list(self.arguments[0])) as span:
+        ret = func()
+        if Action.succeeded(ret):
+          outcome = 'success'
+        elif span:
+          span['status'] = 'failed'
+      return ret
+    except Cancelled:
+      outcome = 'cancelled'
+      raise
+    finally:
+      self.record(operation, time.monotonic() - started, outcome)
+
+  def applyResult(self, ret):
+    if self.method != Action.ACTION_EXECUTE:
+      return None
+    if not Action.succeeded(ret):
+      logging.error(f'Unable to execute command ({self.arguments})')
+      return None
+    self.pid = ret
+    return ret
+
+  @staticmethod
+  def reachable(endpoint):
+    ''' False if the endpoint is known to be down (only remote endpoints can tell) '''
+    available = getattr(endpoint, 'available', None)
+    return available is None or available()
+
+  def _down(self):
+    if self.ifdown == Action.IFDOWN_SKIP:
+      logging.info(f'Skipping {self.method} {self.arguments[0]}, endpoint "{self.endpoint.name}" is down')
+      self.record('execute', None, 'skipped')
+    else:
+      logging.error(f'Unable to {self.method} {self.arguments[0]}, endpoint "{self.endpoint.name}" is down')
+      self.record('execute', None, 'down')
+    return None
+
+  def execute(self):
+    if self.skip:
+      self.skip = False
+      logging.debug(f'Skipping {self.method} {self.arguments[0]}, program started warm')
+      return None
+    if not Action.reachable(self.endpoint):
+      return self._down()
+    if self.warm != -1 and self._adopt():
+      return self.pid
+    if self.adaptive() and self.key and float(self.arguments[0][0]) > 0:
+      return self._delay()
+    ret = self._measure('execute', lambda: Action.dispatch(self.endpoint, self.method, self.options, self.arguments[0]))
+    if self.probe is not None and self.probe.started is not None:
+      ret = self._retry(ret)
+    return self.applyResult(ret)
@@ -13,19 +13,38 @@
 # You should have received a copy of the GNU General Public License
 # along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
 #
+import logging
 from flask import Flask
 from threading import Thread
 
 class WebServer(Thread):
-  def __init__(self, port=8080, listen='0.0.0.0'):
+  SERVER_AUTO = 'auto'
+  SERVER_WAITRESS = 'waitress'
+  SERVER_FLASK = 'flask'
+
+  def __init__(self, port=8080, listen='0.0.0.0', threads=8, server=SERVER_AUTO):
     Thread.__init__(self)
     self.app = Flask(__name__)
     self.port = port
     self.listen = listen
+    self.threads = threads
+    self.server = server
     self.daemon = True
 
   def addRoute(self, url, func, **kwargs):
     self.app.add_url_rule(url, view_func=func, **kwargs)
 
   def run(self):
-    self.app.run(debug=False, port=self.port, host=self.listen)
+    if self.server != WebServer.SERVER_FLASK:
+      try:
+        import waitress
+        logging.info(f'Serving on {self.listen}:{self.port} using waitress with {self.threads} threads')
+        # Reading ahead lets waitress notice clients which went away while
+        # their request (like an event stream) is still being served
+        waitress.serve(self.app, host=self.listen, port=self.port, threads=self.threads, channel_request_lookahead=1)
+        return
+      except ImportError:
+        if self.server == WebServer.SERVER_WAITRESS:
+          raise
+        logging.warning('waitress is not installed, falling back to the Flask development server')
+    self.app.run(debug=False, port=self.port, host=self.listen, threaded=True)
@@ -0,0 +1,94 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import re
+import string
+import logging
+from threading import Lock
+
+import yaml
+
+SENTINEL = re.compile(r'__WOPARAM_(\d+)__')
+
+class Template:
+  ''' A YAML file with {name} placeholders, parsed once
+
+  Placeholders are swapped for sentinels before parsing and only filled
+  in afterwards, so values never go through the YAML parser (and can't
+  break it). A value taking up a whole scalar keeps its type. As with
+  str.format, {{ and }} stand for literal braces.
+  '''
+  def __init__(self, text, name):
+    self.name = name
+    self.fields = []
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(text):
+      parts.append(literal.replace('{', '{{').replace('}', '}}'))
+      if field is not None:
+        parts.append(f'__WOPARAM_{len(self.fields)}__')
+        self.fields.append('{' + field + (f'!{conversion}' if conversion else '') + (f':{spec}' if spec else '') + '}')
+    # The literal text is put back through format(), which also turns {{ into {
+    self.tree = yaml.safe_load(''.join(parts).format())
+
+  def _field(self, index, parameters, missing):
+    try:
+      return self.fields[index].format_map(parameters)
+    except (KeyError, IndexError, AttributeError, ValueError):
+      missing.add(self.fields[index])
+      return self.fields[index]
+
+  def _substitute(self, node, parameters, missing):
+    if isinstance(node, dict):
+      return {self._substitute(key, parameters, missing) : self._substitute(value, parameters, missing) for key, value in node.items()}
+    if isinstance(node, list):
+      return [self._substitute(value, parameters, missing) for value in node]
+    if not isinstance(node, str) or '__WOPARAM_' not in node:
+      return node
+    whole = SENTINEL.fullmatch(node)
+    if whole and self.fields[int(whole.group(1))][1:-1] in parameters:
+      return parameters[self.fields[int(whole.group(1))][1:-1]]
+    return SENTINEL.sub(lambda match: self._field(int(match.group(1)), parameters, missing), node)
+
+  def render(self, parameters):
+    ''' Returns the parsed file with the placeholders filled in from parameters '''
+    missing = set()
+    data = self._substitute(self.tree, parameters, missing)
+    if missing:
+      logging.warning(f'{self.name} uses {", ".join(sorted(missing))} but no value was given, left as is')
+    return data
+
+class TemplateCache:
+  ''' Keeps parsed templates until their file changes '''
+  def __init__(self):
+    self.templates = {}
+    self.lock = Lock()
+
+  def get(self, file):
+    ''' Returns the template for file, or None if it doesn't exist '''
+    try:
+      mtime = os.path.getmtime(file)
+    except OSError:
+      return None
+    key = os.path.abspath(file)
+    with self.lock:
+      cached = self.templates.get(key, None)
+    if cached and cached[0] == mtime:
+      return cached[1]
+    with open(file) as f:
+      template = Template(f.read(), file)
+    with self.lock:
+      self.templates[key] = (mtime, template)
+    return template
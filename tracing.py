@@ -0,0 +1,199 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import cancellation
+
+HOST = socket.gethostname()
+
+class Context:
+  ''' The trace new spans belong to, the span they're part of and where to
+  send a copy of them (used to hand spans back to the instance which
+  started the trace)
+  '''
+  def __init__(self, trace, parent=None, sink=None):
+    self.trace = trace
+    self.parent = parent
+    self.sink = sink
+
+class TraceStore:
+  ''' Keeps the spans of the most recent traces '''
+  def __init__(self, keep=50):
+    self.keep = keep
+    self.traces = OrderedDict()
+    self.lock = threading.Lock()
+
+  def add(self, trace, spans):
+    with self.lock:
+      if trace not in self.traces:
+        self.traces[trace] = {}
+        while len(self.traces) > self.keep:
+          self.traces.popitem(last=False)
+      for span in spans:
+        self.traces[trace][span['id']] = span
+
+  def get(self, trace):
+    ''' Returns the spans of a trace ordered by start time, or None '''
+    with self.lock:
+      if trace not in self.traces:
+        return None
+      spans = list(self.traces[trace].values())
+    return sorted(spans, key=lambda span: span['start'])
+
+  def summary(self):
+    ''' Lists the known traces, newest first '''
+    with self.lock:
+      traces = [(trace, list(spans.values())) for trace, spans in self.traces.items()]
+    result = []
+    for trace, spans in reversed(traces):
+      roots = [span for span in spans if span['parent'] is None] or spans
+      root = min(roots, key=lambda span: span['start'])
+      result.append({
+        'trace' : trace,
+        'name' : root['name'],
+        'start' : root['start'],
+        'duration' : root['duration'],
+        'spans' : len(spans),
+        'hosts' : sorted({span['host'] for span in spans}),
+      })
+    return result
+
+_store = TraceStore()
+_local = threading.local()
+
+def store():
+  return _store
+
+def current():
+  return getattr(_local, 'context', None)
+
+@contextmanager
+def activate(context):
+  ''' Makes context the current one for this thread '''
+  previous = current()
+  _local.context = context
+  try:
+    yield
+  finally:
+    _local.context = previous
+
+def bind(func):
+  ''' Wraps func so spans it records belong to the caller's trace, even on another thread '''
+  context = current()
+  def bound(*args, **kwargs):
+    with activate(context):
+      return func(*args, **kwargs)
+  return bound
+
+def _new_id():
+  return uuid.uuid4().hex[:16]
+
+@contextmanager
+def span(name, **attributes):
+  ''' Records how long the enclosed code takes as part of the current trace
+
+  Does nothing unless a trace is active. Yields the span (or None) so
+  attributes can be added along the way.
+  '''
+  context = current()
+  if context is None:
+    yield None
+    return
+
+  entry = {
+    'trace' : context.trace,
+    'id' : _new_id(),
+    'parent' : context.parent,
+    'name' : name,
+    'host' : HOST,
+    'start' : time.time(),
+    'duration' : None,
+    'status' : 'ok',
+    'attributes' : attributes,
+  }
+  started = time.monotonic()
+  try:
+    with activate(Context(context.trace, entry['id'], context.sink)):
+      yield entry
+  except cancellation.Cancelled:
+    entry['status'] = 'cancelled'
+    raise
+  except Exception as e:
+    entry['status'] = 'error'
+    entry['attributes']['error'] = str(e)
+    raise
+  finally:
+    entry['duration'] = time.monotonic() - started
+    _store.add(context.trace, [entry])
+    if context.sink is not None:
+      context.sink.append(entry)
+
+@contextmanager
+def trace(name, **attributes):
+  ''' Starts a new trace with a span covering the enclosed code
+
+  Within a trace which is already active, this is just another span.
+  '''
+  if current() is not None:
+    with span(name, **attributes) as entry:
+      yield entry
+    return
+  with activate(Context(_new_id())):
+    with span(name, **attributes) as entry:
+      logging.debug(f'Started trace {entry["trace"]} ({name})')
+      yield entry
+
+def header():
+  ''' Describes the current trace for passing it on to a remote, or None '''
+  context = current()
+  if context is None:
+    return None
+  return {'id' : context.trace, 'parent' : context.parent}
+
+@contextmanager
+def resume(header):
+  ''' Continues a trace started elsewhere, as described by header()
+
+  Yields the list which collects the spans recorded meanwhile, so they
+  can be sent back. Without a header, no trace is resumed.
+  '''
+  spans = []
+  if not isinstance(header, dict) or 'id' not in header:
+    yield spans
+    return
+  with activate(Context(str(header['id']), header.get('parent', None), spans)):
+    yield spans
+
+def merge(spans):
+  ''' Adds spans recorded by a remote to their traces '''
+  for span in spans or []:
+    if isinstance(span, dict) and 'trace' in span and 'id' in span:
+      _store.add(span['trace'], [span])
+
+class LogFilter(logging.Filter):
+  ''' Adds the current trace id as "trace" to log records, so log lines
+  from the instances involved in a trace can be tied together
+  '''
+  def filter(self, record):
+    context = current()
+    record.trace = f'[{context.trace}] ' if context else ''
+    return True
@@ -0,0 +1,387 @@
+# This file is part of window-opener (https://github.com/mrworf/window-opener).
+#
+# window-opener is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# window-opener is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
+#
+import re
+import time
+import itertools
+from functools import lru_cache
+from threading import Condition, Lock
+
+import cancellation
+
+class WindowBackend:
+  ''' Access to the windowing system
+
+  Besides answering queries about windows, a backend reports changes by
+  calling the notify function given to start() with one of the event
+  names below and the handle of the window concerned. Notifications may
+  come from any thread.
+  '''
+  CREATED = 'created'
+  DESTROYED = 'destroyed'
+  SHOWN = 'shown'
+  HIDDEN = 'hidden'
+  FOREGROUND = 'foreground'
+  MINIMIZED = 'minimized'
+  RESTORED = 'restored'
+  RENAMED = 'renamed'
+
+  def start(self, notify):
+    raise NotImplementedError()
+
+  def enumerate(self):
+    ''' Returns the handles of all top-level windows '''
+    raise NotImplementedError()
+
+  def title(self, handle):
+    ''' Returns the title of a window, or None if it no longer exists '''
+    raise NotImplementedError()
+
+  def foreground(self):
+    raise NotImplementedError()
+
+  def pid(self, handle):
+    ''' Returns the id of the process owning a window '''
+    raise NotImplementedError()
+
+  def is_visible(self, handle):
+    raise NotImplementedError()
+
+  def is_iconic(self, handle):
+    raise NotImplementedError()
+
+  def close(self, handle):
+    raise NotImplementedError()
+
+  def activate(self, handle, maximize=False, restore=False):
+    raise NotImplementedError()
+
+class FakeBackend(WindowBackend):
+  ''' In-memory windowing system, for driving window actions without Windows '''
+  def __init__(self):
+    self.notify = lambda event, handle: None
+    self.windows = {}
+    self.active = 0
+    self.handles = itertools.count(1)
+    self.lock = Lock()
+
+  def start(self, notify):
+    self.notify = notify
+
+  def create(self, title, visible=True, iconic=False, pid=0):
+    with self.lock:
+      handle = next(self.handles)
+      self.windows[handle] = {'title' : title, 'visible' : visible, 'iconic' : iconic, 'pid' : pid}
+    self.notify(WindowBackend.CREATED, handle)
+    return handle
+
+  def destroy(self, handle):
+    with self.lock:
+      self.windows.pop(handle, None)
+      if self.active == handle:
+        self.active = 0
+    self.notify(WindowBackend.DESTROYED, handle)
+
+  def rename(self, handle, title):
+    with self.lock:
+      self.windows[handle]['title'] = title
+    self.notify(WindowBackend.RENAMED, handle)
+
+  def set_visible(self, handle, visible):
+    with self.lock:
+      self.windows[handle]['visible'] = visible
+    self.notify(WindowBackend.SHOWN if visible else WindowBackend.HIDDEN, handle)
+
+  def set_iconic(self, handle, iconic):
+    with self.lock:
+      self.windows[handle]['iconic'] = iconic
+    self.notify(WindowBackend.MINIMIZED if iconic else WindowBackend.RESTORED, handle)
+
+  def set_foreground(self, handle):
+    with self.lock:
+      self.active = handle
+    self.notify(WindowBackend.FOREGROUND, handle)
+
+  def enumerate(self):
+    with self.lock:
+      return list(self.windows.keys())
+
+  def title(self, handle):
+    info = self.windows.get(handle, None)
+    return info['title'] if info else None
+
+  def foreground(self):
+    return self.active
+
+  def pid(self, handle):
+    info = self.windows.get(handle, None)
+    return info['pid'] if info else 0
+
+  def is_visible(self, handle):
+    return handle in self.windows and self.windows[handle]['visible']
+
+  def is_iconic(self, handle):
+    return handle in self.windows and self.windows[handle]['iconic']
+
+  def close(self, handle):
+    if handle not in self.windows:
+      return False
+    self.destroy(handle)
+    return True
+
+  def activate(self, handle, maximize=False, restore=False):
+    if handle not in self.windows:
+      return False
+    if restore and not maximize:
+      self.set_iconic(handle, False)
+    self.set_visible(handle, True)
+    self.set_foreground(handle)
+    return True
+
+@lru_cache(maxsize=64)
+def _compile(pattern):
+  return re.compile(pattern)
+
+class WindowRegistry:
+  ''' Index of top-level windows by title
+
+  The index is built by enumerating all windows once and then kept up
+  to date from window events, so lookups don't have to ask the system.
+  '''
+  EXACT = 'exact'
+  PREFIX = 'prefix'
+  REGEX = 'regex'
+  MATCHES = [EXACT, PREFIX, REGEX]
+
+  @staticmethod
+  def invalid(title, match):
+    ''' Tells what's wrong with looking for title this way, or None if nothing is '''
+    if match not in WindowRegistry.MATCHES:
+      return f"match must be one of {', '.join(WindowRegistry.MATCHES)}, not \"{match}\""
+    if match == WindowRegistry.REGEX:
+      try:
+        _compile(title)
+      except re.error as e:
+        return f'"{title}" is not a valid regular expression ({e})'
+    return None
+
+  def __init__(self, backend, stale=5.0):
+    self.backend = backend
+    self.stale = stale
+    self.titles = {}
+    self.index = {}
+    self.synced = False
+    self.refreshed = 0
+    self.lock = Lock()
+
+  def _remove(self, handle):
+    title = self.titles.pop(handle, None)
+    if title is not None:
+      handles = self.index[title]
+      handles.remove(handle)
+      if not handles:
+        del self.index[title]
+
+  def _update(self, handle, title):
+    if self.titles.get(handle, None) == title:
+      return
+    self._remove(handle)
+    if title is not None:
+      self.titles[handle] = title
+      self.index.setdefault(title, []).append(handle)
+
+  def refresh(self):
+    ''' Rebuilds the index from scratch '''
+    windows = [(handle, self.backend.title(handle)) for handle in self.backend.enumerate()]
+    with self.lock:
+      self.titles = {}
+      self.index = {}
+      for handle, title in windows:
+        self._update(handle, title)
+      self.synced = True
+      self.refreshed = time.monotonic()
+
+  def event(self, kind, handle):
+    if not self.synced:
+      return
+    if kind == WindowBackend.DESTROYED:
+      with self.lock:
+        self._remove(handle)
+    elif kind in [WindowBackend.CREATED, WindowBackend.RENAMED, WindowBackend.SHOWN]:
+      title = self.backend.title(handle)
+      with self.lock:
+        self._update(handle, title)
+
+  def _match(self, current, title, match):
+    if match == WindowRegistry.EXACT:
+      return current == title
+    elif match == WindowRegistry.PREFIX:
+      return current.startswith(title)
+    elif match == WindowRegistry.REGEX:
+      return _compile(title).search(current) is not None
+    raise ValueError(f'Unknown match "{match}"')
+
+  def _lookup(self, title, match):
+    with self.lock:
+      if match == WindowRegistry.EXACT:
+        candidates = list(self.index.get(title, []))
+      else:
+        candidates = [h for t, handles in self.index.items() if self._match(t, title, match) for h in handles]
+
+    for handle in candidates:
+      # Double check, in case an event went missing
+      current = self.backend.title(handle)
+      if current is not None and self._match(current, title, match):
+        return handle
+      with self.lock:
+        self._update(handle, current)
+    return 0
+
+  def find(self, title, match=EXACT):
+    ''' Returns the handle of a window matching title, or 0 if none does '''
+    if not self.synced:
+      self.refresh()
+    handle = self._lookup(title, match)
+    if not handle and time.monotonic() - self.refreshed > self.stale:
+      # Nothing found, make sure it's not because we missed its creation
+      self.refresh()
+      handle = self._lookup(title, match)
+    return handle
+
+  def owned(self, pid):
+    ''' Returns the handles of all titled windows belonging to process pid '''
+    if not self.synced or time.monotonic() - self.refreshed > self.stale:
+      self.refresh()
+    with self.lock:
+      handles = [h for h, t in self.titles.items() if t]
+    return [handle for handle in handles if self.backend.pid(handle) == pid]
+
+  def snapshot(self):
+    ''' Lists all titled windows along with their state '''
+    if not self.synced or time.monotonic() - self.refreshed > self.stale:
+      self.refresh()
+    with self.lock:
+      windows = [(h, t) for h, t in self.titles.items() if t]
+    active = self.backend.foreground()
+    return [{
+      'handle' : handle,
+      'title' : title,
+      'visible' : bool(self.backend.is_visible(handle)),
+      'iconic' : bool(self.backend.is_iconic(handle)),
+      'active' : handle == active,
+    } for handle, title in windows]
+
+class WindowWatcher:
+  ''' Wakes up anyone waiting on a window condition as soon as something changes
+
+  Conditions are re-evaluated whenever the backend reports an event, and
+  once every "recheck" seconds in case a change went unreported.
+  '''
+  def __init__(self, backend, recheck=1.0):
+    self.backend = backend
+    self.recheck = recheck
+    self.generation = 0
+    self.condition = Condition()
+    self.registry = WindowRegistry(backend)
+    self.listeners = [self.registry.event]
+    backend.start(self._notify)
+
+  def _wake(self):
+    with self.condition:
+      self.generation += 1
+      self.condition.notify_all()
+
+  def _notify(self, event, handle):
+    for listener in self.listeners:
+      listener(event, handle)
+    self._wake()
+
+  def subscribe(self, listener):
+    ''' Calls listener(event, handle) for every window event '''
+    self.listeners.append(listener)
+
+  def find(self, title, match=WindowRegistry.EXACT):
+    return self.registry.find(title, match)
+
+  def owned(self, pid):
+    return self.registry.owned(pid)
+
+  def snapshot(self):
+    return self.registry.snapshot()
+
+  def foreground(self):
+    return self.backend.foreground()
+
+  def is_visible(self, handle):
+    return self.backend.is_visible(handle)
+
+  def is_iconic(self, handle):
+    return self.backend.is_iconic(handle)
+
+  def close(self, handle):
+    return self.backend.close(handle)
+
+  def activate(self, handle, maximize=False, restore=False):
+    return self.backend.activate(handle, maximize, restore)
+
+  def wait(self, check, timeout=0):
+    ''' Waits until check() returns something truthy and returns it
+
+    A timeout of zero means waiting forever. On timeout, the last
+    (falsy) result of check() is returned. Raises Cancelled if the
+    current cancel token is cancelled while waiting.
+    '''
+    deadline = time.monotonic() + timeout if timeout > 0 else None
+    token = cancellation.current()
+    forget = token.onCancel(self._wake)
+    try:
+      while True:
+        token.check()
+        with self.condition:
+          seen = self.generation
+        result = check()
+        if result:
+          return result
+
+        delay = self.recheck
+        if deadline is not None:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            return result
+          delay = min(delay, remaining)
+
+        with self.condition:
+          if self.generation == seen:
+            self.condition.wait(delay)
+    finally:
+      forget()
+
+_watcher = None
+_lock = Lock()
+
+def install(backend):
+  ''' Replaces the window backend used by the local endpoint '''
+  global _watcher
+  with _lock:
+    _watcher = WindowWatcher(backend)
+  return _watcher
+
+def watcher(default=None):
+  ''' Returns the shared watcher, creating it from default() if needed '''
+  global _watcher
+  with _lock:
+    if _watcher is None and default is not None:
+      _watcher = WindowWatcher(default())
+    return _watcher
@@ -13,19 +13,16 @@
 # You should have received a copy of the GNU General Public License
 # along with window-opener.  If not, see <http://www.gnu.org/licenses/>.
 #
-from flask import jsonify, abort, request
 import logging
 import argparse
-from threading import Lock
+from threading import Lock, BoundedSemaphore
 import ctypes
 import sys
+import time
+import json
 
-from programs import Action
-from endpoints import LocalEndpoint
-from configuration import Config
-from systray import Menu
-from server import WebServer
 from logger import StreamToLogger
+import tracing
 
 parser = argparse.ArgumentParser(description="WindowOpener - A windows REST API automation tool", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--port', default=8080, type=int, help="Port to listen on")
@@ -34,6 +31,10 @@ parser.add_argument('--debug', action='store_true', default=False, help='Enable
 parser.add_argument('--lowlevel', choices=['yes', 'no'], default='yes', help='Enable lowlevel REST API')
 parser.add_argument('--program', choices=['yes', 'no'], default='yes', help='Enable program REST API')
 parser.add_argument('--logfile', default=None, help="Log to file instead of stdout")
+parser.add_argument('--server', choices=['auto', 'waitress', 'flask'], default='auto', help='Web server to use, auto picks waitress when installed')
+parser.add_argument('--threads', default=8, type=int, help='Number of threads serving requests')
+parser.add_argument('--autoreload', action='store_true', default=False, help='Reload configuration automatically when its files change')
+parser.add_argument('--cache', default=None, help='Keep the parsed configuration in this file, used on startup as long as no configuration file changed')
 cmdline = parser.parse_args()
 
 # This is CRUCIAL or pythonw.exe usage will be unpredictable
@@ -47,17 +48,90 @@ if 'pythonw.exe' in sys.executable:
   logfile = 'windowopener.log' if not cmdline.logfile else cmdline.logfile
 
 if cmdline.debug:
-  logging.basicConfig(filename=logfile, level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+  logging.basicConfig(filename=logfile, level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(trace)s%(message)s')
 else:
-  logging.basicConfig(filename=logfile, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+  logging.basicConfig(filename=logfile, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(trace)s%(message)s')
+for handler in logging.getLogger().handlers:
+  handler.addFilter(tracing.LogFilter())
 
 if not has_console:
   logging.info('Running from pythonw, capturing all STDOUT/STDERR to log')
 
-config = Config()
+# Only pull in the rest once the command line is known to be good. The
+# endpoints load their platform modules on first use, not here.
+from flask import jsonify, abort, request, Response
+
+from programs import Action
+from endpoints import LocalEndpoint
+from configuration import Config, ConfigWatcher
+from health import HealthMonitor
+from server import WebServer
+from jobs import JobManager
+import metrics
+
+# Seconds between keepalives on an idle event stream
+EVENTS_HEARTBEAT = 15
+# Longest a GET /program may wait for a change
+PROGRAM_MAXWAIT = 60
+# How long the body of GET /program may be reused, while the figures in
+# it which don't change its version (like endpoint latency) stay fresh
+PROGRAM_REUSE = 1.0
+
+config = Config(cache=cmdline.cache)
 config.load()
 
 pm = config.getProgramManager()
+jobs = JobManager(config)
+if cmdline.autoreload:
+  ConfigWatcher(config).start()
+HealthMonitor(config).start()
+
+# Every event stream and waiting GET /program occupies a serving thread
+# for as long as it lasts, at most half of them may be taken so /program
+# and /lowlevel calls always find one free
+parked = BoundedSemaphore(cmdline.threads // 2)
+
+state = {'version' : None, 'built' : 0, 'body' : None}
+state_lock = Lock()
+
+def _program_state(version):
+  ''' The body of GET /program, built once per version '''
+  with state_lock:
+    if state['version'] != version or time.monotonic() - state['built'] > PROGRAM_REUSE:
+      state['body'] = json.dumps({
+        'programs' : pm.getPrograms(),
+        'active' : pm.getActiveProgram(),
+        'running' : pm.getActivePrograms(),
+        'warm' : pm.getWarmPrograms(),
+        'endpoints' : pm.getEndpointHealth(),
+      })
+      state['version'] = version
+      state['built'] = time.monotonic()
+    return state['body']
+
+def get_program():
+  ''' Answers with 304 if the client has the current state, after waiting up to "wait" seconds for it to change
+
+  Should too many threads be busy waiting already, it answers right away.
+  '''
+  version = pm.getVersion()
+  wait = min(request.args.get('wait', 0, type=float), PROGRAM_MAXWAIT)
+  busy = False
+  if wait > 0 and request.if_none_match.contains_weak(str(version)):
+    if parked.acquire(blocking=False):
+      try:
+        version = pm.waitForChange(version, wait)
+      finally:
+        parked.release()
+    else:
+      logging.debug('Too many requests waiting, answering right away')
+      busy = True
+  result = Response(_program_state(version), content_type='application/json')
+  if busy:
+    result.headers['Retry-After'] = '1'
+  result.set_etag(str(version), weak=True)
+  result.headers['Cache-Control'] = 'no-cache'
+  return result.make_conditional(request)
 
 def get_action():
   if cmdline.program != 'yes':
@@ -65,16 +139,25 @@ def get_action():
   elif not config.getToken():
     abort(404)
 
+  status = 200
   if request.method == 'GET':
-    active = pm.getActiveProgram()
-    ret = {'programs' : pm.getPrograms(), 'active' : active.name if active else None}
+    return get_program()
   elif request.method == 'POST':
     j = request.json
     if 'token' not in j or j['token'] != config.getToken():
       logging.error('Token either missing from request or wrong')
       abort(403)
 
-    if 'start' in j and j['start'] in pm.getPrograms():
+    if j.get('async', False):
+      if 'start' in j and j['start'] in pm.getPrograms():
+        job = jobs.submit('start', j['start'])
+      elif 'stop' in j and (j['stop'] in pm.getPrograms() or not j['stop']):
+        job = jobs.submit('stop', j['stop'])
+      else:
+        abort(404, 'No such program')
+      ret = {'job' : job.id}
+      status = 202
+    elif 'start' in j and j['start'] in pm.getPrograms():
       ret = {'result' : pm.start(j['start']) != None }
     elif 'stop' in j and j['stop'] in pm.getPrograms():
       ret = {'result' : pm.stop(j['stop'])}
@@ -84,60 +167,195 @@ def get_action():
     abort(500)
 
   result = jsonify(ret)
+  result.status_code = status
+  return result
+
+def _sse(kind, data, id=None):
+  event = f'id: {id}\n' if id is not None else ''
+  return event + f'event: {kind}\ndata: {json.dumps(data)}\n\n'
+
+def get_events():
+  ''' Streams program switches and action progress as server-sent events '''
+  if cmdline.program != 'yes':
+    abort(403)
+  elif not config.getToken():
+    abort(404)
+
+  if not parked.acquire(blocking=False):
+    logging.warning('Too many event streams open, turning a client away')
+    abort(503, 'Too many event streams open, try again later')
+
+  subscription = pm.events.subscribe()
+  def stream():
+    try:
+      dropped = 0
+      yield _sse('active', {'active' : pm.getActiveProgram(), 'running' : pm.getActivePrograms(), 'programs' : pm.getPrograms()})
+      while True:
+        events = subscription.get(EVENTS_HEARTBEAT)
+        if subscription.dropped != dropped:
+          yield _sse('dropped', {'count' : subscription.dropped - dropped})
+          dropped = subscription.dropped
+        if not events:
+          # Keeps proxies from timing out and finds out if the client is gone
+          yield ': keepalive\n\n'
+        for id, kind, data in events:
+          yield _sse(kind, data, id)
+    finally:
+      pm.events.unsubscribe(subscription)
+
+  result = Response(stream(), mimetype='text/event-stream', headers={'Cache-Control' : 'no-cache', 'X-Accel-Buffering' : 'no'})
+  # Also runs if the client goes away before the stream got going
+  result.call_on_close(parked.release)
+  return result
+
+def get_job(id):
+  if cmdline.program != 'yes':
+    abort(403)
+  elif not config.getToken():
+    abort(404)
+
+  job = jobs.get(id)
+  if not job:
+    abort(404, 'No such job')
+  result = jsonify(job.toDict())
   result.status_code = 200
   return result
 
-def post_lowlevel(method):
+def _check_lowlevel():
   if cmdline.lowlevel != 'yes':
     abort(403)
   elif not config.getToken():
     abort(404)
 
-  ret = {'result' : None}
   j = request.json
   if 'token' not in j or j['token'] != config.getToken():
     logging.error('Token either missing from request or wrong')
     abort(403)
+  return j
+
+LOWLEVEL_CALLS = metrics.counter('windowopener_lowlevel_calls_total', 'Lowlevel calls handled, by outcome', ['method', 'outcome'])
+LOWLEVEL_SECONDS = metrics.histogram('windowopener_lowlevel_duration_seconds', 'Time taken to handle lowlevel calls', ['method'])
 
-  if method not in Action.METHOD_START and method not in Action.METHOD_STOP:
+def _lowlevel(ep, method, options, arguments, delays=False):
+  started = time.monotonic()
+  ret = False
+  try:
+    if method == Action.ACTION_DELAY and not delays:
+      logging.info('Ignoring delay method')
+      return False
+    with tracing.span(f'lowlevel {method}', arguments=arguments) as span:
+      ret = Action.dispatch(ep, method, options, arguments)
+      if method == Action.ACTION_EXECUTE and ret == -1:
+        ret = None
+      if span and not Action.succeeded(ret):
+        span['status'] = 'failed'
+    return ret
+  except:
+    logging.exception(f'Failed to execute "{method}" with arguments {arguments} and options {options}')
+    return False
+  finally:
+    LOWLEVEL_CALLS.inc(method, 'success' if Action.succeeded(ret) else 'failure')
+    LOWLEVEL_SECONDS.observe(time.monotonic() - started, method)
+
+def post_lowlevel_ping():
+  ''' Lets other instances check that this one is up '''
+  _check_lowlevel()
+  return jsonify({'result' : True})
+
+def post_lowlevel(method):
+  j = _check_lowlevel()
+
+  ret = {'result' : None}
+  if method not in Action.METHOD_START + Action.METHOD_STOP + Action.METHOD_INTERNAL:
     abort(404, f'No such method ({method})')
   elif 'arguments' not in j or not isinstance(j['arguments'], list):
     abort(500, 'Corrupt request')
   else:
-    ep = LocalEndpoint('req')
-    try:
-      if method == Action.ACTION_EXECUTE:
-        ret['result'] = ep.execute(j['options'], j['arguments'])
-        if ret['result'] == -1:
-          ret['result'] = None
-      elif method == Action.ACTION_DELAY:
-        logging.info('Ignoring delay method')
-        ret['result'] = False
-      elif method == Action.ACTION_KILL_APP:
-        ret['result'] = ep.kill_app(j['options'], j['arguments'][0])
-      elif method == Action.ACTION_KILL_PID:
-        ret['result'] = ep.kill_pid(j['options'], j['arguments'][0])
-      elif method == Action.ACTION_CLOSE_WINDOW:
-        ret['result'] = ep.close_window(j['options'], j['arguments'][0])
-      elif method == Action.ACTION_FOCUS:
-        ret['result'] = ep.focus(j['options'], j['arguments'][0])
-      elif method == Action.ACTION_MOUSE_MOVE:
-        ret['result'] = ep.mouse_move(j['options'], j['arguments'][0], j['arguments'][1])
-    except:
-      logging.exception(f'Failed to execute "{method}" with arguments {j["arguments"]} and options {j["options"]}')
-      ret['result'] = False
+    with tracing.resume(j.get('trace', None)) as spans:
+      ret['result'] = _lowlevel(LocalEndpoint('req'), method, j.get('options', None) or {}, j['arguments'])
+    if 'trace' in j:
+      ret['spans'] = spans
+
+  result = jsonify(ret)
+  result.status_code = 200
+  return result
+
+def post_lowlevel_batch():
+  ''' Runs a list of lowlevel calls in order, delays included '''
+  j = _check_lowlevel()
+
+  if 'actions' not in j or not isinstance(j['actions'], list):
+    abort(500, 'Corrupt request')
+  for entry in j['actions']:
+    if not isinstance(entry, dict) or not isinstance(entry.get('arguments', None), list):
+      abort(500, 'Corrupt request')
+    if entry.get('method', None) not in Action.METHOD_START + Action.METHOD_STOP + Action.METHOD_INTERNAL:
+      abort(404, f'No such method ({entry.get("method", None)})')
+
+  ep = LocalEndpoint('req')
+  results = []
+  with tracing.resume(j.get('trace', None)) as spans:
+    for entry in j['actions']:
+      started = time.monotonic()
+      value = _lowlevel(ep, entry['method'], entry.get('options', None) or {}, entry['arguments'], delays=True)
+      results.append({'result' : value, 'duration' : time.monotonic() - started})
+
+  ret = {'results' : results}
+  if 'trace' in j:
+    ret['spans'] = spans
+  result = jsonify(ret)
+  result.status_code = 200
+  return result
+
+def post_lowlevel_windows():
+  j = _check_lowlevel()
+
+  ret = {'result' : None}
+  try:
+    ret['result'] = LocalEndpoint('req').windows(j.get('options', None) or {})
+  except:
+    logging.exception('Failed to list windows')
+    ret['result'] = False
 
   result = jsonify(ret)
   result.status_code = 200
   return result
 
+def get_traces():
+  if cmdline.program != 'yes':
+    abort(403)
+  elif not config.getToken():
+    abort(404)
+
+  result = jsonify({'traces' : tracing.store().summary()})
+  result.status_code = 200
+  return result
+
+def get_trace(id):
+  if cmdline.program != 'yes':
+    abort(403)
+  elif not config.getToken():
+    abort(404)
+
+  spans = tracing.store().get(id)
+  if spans is None:
+    abort(404, 'No such trace')
+  result = jsonify({'trace' : id, 'spans' : spans})
+  result.status_code = 200
+  return result
+
+def get_metrics():
+  if cmdline.program != 'yes':
+    abort(403)
+  elif not config.getToken():
+    abort(404)
+
+  return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 def onReload(systray):
   MessageBox = ctypes.windll.user32.MessageBoxW
-  if pm.getActiveProgram():
-    MessageBox(None, 'Can\'t reload configuration with an active program', 'WindowOpener', 0)
-  else:
-    config.load()
-    MessageBox(None, 'Configuration has been reloaded', 'WindowOpener', 0)
+  config.reload()
+  MessageBox(None, 'Configuration has been reloaded', 'WindowOpener', 0)
 
 def onAbout(systray):
   MessageBox = ctypes.windll.user32.MessageBoxW
@@ -156,15 +374,23 @@ For more details, see https://github.com/mrworf/window-opener/
 running = Lock()
 running.acquire()
 
-server = WebServer()
+server = WebServer(port=cmdline.port, listen=cmdline.listen, threads=cmdline.threads, server=cmdline.server)
 server.addRoute('/program', get_action, methods=['GET', 'POST'])
+server.addRoute('/program/job/<id>', get_job, methods=['GET'])
+server.addRoute('/program/events', get_events, methods=['GET'])
+server.addRoute('/lowlevel/batch', post_lowlevel_batch, methods=['POST'])
+server.addRoute('/lowlevel/windows', post_lowlevel_windows, methods=['POST'])
+server.addRoute('/lowlevel/ping', post_lowlevel_ping, methods=['POST'])
 server.addRoute('/lowlevel/<method>', post_lowlevel, methods=['POST'])
-
-systray = Menu(onReload, lambda _: running.release(), onAbout)
+server.addRoute('/trace', get_traces, methods=['GET'])
+server.addRoute('/trace/<id>', get_trace, methods=['GET'])
+server.addRoute('/metrics', get_metrics, methods=['GET'])
 
 if has_console:
   server.run()
 else:
+  from systray import Menu
+  systray = Menu(onReload, lambda _: running.release(), onAbout)
   logging.debug('Starting web server')
   server.start()
   logging.debug('Starting systray icon')